@@ -0,0 +1,234 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# the lambda modules are imported from ../lambda, as the Lambda runtime would see them
+LAMBDA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+
+BENCHMARK_BUCKET_NAME = "benchmark-bucket"
+BENCHMARK_PREFIX = "benchmark"
+
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 * 1024, 'GB': 1024 * 1024 * 1024}
+
+# each mode is a set of event overrides for download_s3_objects
+BENCHMARK_MODES = {
+    'sequential': {'max_concurrency': 1, 'multipart_threshold': 0},
+    'concurrent': {'multipart_threshold': 0},
+    'ranged': {},
+    'async': {'use_async': True, 'multipart_threshold': 0},
+}
+
+
+def parse_size(size):
+    # "4KB" -> 4096
+    size = size.strip().upper()
+    for unit in ('KB', 'MB', 'GB', 'B'):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(size)
+
+
+def parse_object_spec(object_spec):
+    # "1000x4KB,2x64MB" -> [(1000, 4096), (2, 67108864)]
+    object_groups = []
+    for group in object_spec.split(","):
+        count, size = group.split("x")
+        object_groups.append((int(count), parse_size(size)))
+    return object_groups
+
+
+def seed_objects(endpoint_url, object_spec):
+    import boto3
+
+    s3 = boto3.client('s3', region_name='us-east-1', endpoint_url=endpoint_url)
+    s3.create_bucket(Bucket=BENCHMARK_BUCKET_NAME)
+
+    # one random buffer sliced per object keeps seeding cheap
+    object_groups = parse_object_spec(object_spec)
+    payload = os.urandom(max(size for _, size in object_groups))
+
+    keys_and_sizes = []
+    for group_index, (count, size) in enumerate(object_groups):
+        for object_index in range(count):
+            # spread objects over a few sub-prefixes, like a real dataset
+            key = "%s/group%d/part%03d/object%07d.bin" % (BENCHMARK_PREFIX, group_index, object_index % 100, object_index)
+            keys_and_sizes.append((key, size))
+
+    def put_object(key_and_size):
+        key, size = key_and_size
+        s3.put_object(Bucket=BENCHMARK_BUCKET_NAME, Key=key, Body=payload[:size])
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(put_object, keys_and_sizes))
+
+    total_bytes = sum(size for _, size in keys_and_sizes)
+    print("seed_objects: Seeded %d objects, %d bytes." % (len(keys_and_sizes), total_bytes))
+
+
+def percentile(values, fraction):
+    # None when nothing was timed, printed as "n/a" rather than a made-up 0
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def get_peak_rss_mb():
+    # VmHWM is the peak RSS of this process image; ru_maxrss on Linux also
+    # carries over the high-water mark of the parent that forked us
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(endpoint_url, mode, max_concurrency, part_size, threshold):
+    # runs in a child process, so the peak RSS is that of this mode alone
+    sys.path.insert(0, LAMBDA_PATH)
+    import config
+    import lambda_handler
+    import s3_async_util
+    import s3_util
+
+    target_path_root = tempfile.mkdtemp(prefix="benchmark_download_")
+    event = {
+        "profile_name": "",
+        "region_name": "us-east-1",
+        "endpoint_url": endpoint_url,
+        "source_bucket_name": BENCHMARK_BUCKET_NAME,
+        "source_dataset_prefix": BENCHMARK_PREFIX,
+        "target_path_root": target_path_root,
+        "max_concurrency": max_concurrency,
+        "multipart_threshold": threshold,
+        "multipart_part_size": part_size,
+    }
+    event.update(BENCHMARK_MODES[mode])
+
+    # time every download_s3_object call, and every download_s3_object_async call for the
+    # aiobotocore async path (without aiobotocore it runs download_s3_object in threads)
+    latencies = []
+    download_s3_object = s3_util.download_s3_object
+    download_s3_object_async = s3_async_util.download_s3_object_async
+
+    def timed_download_s3_object(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return download_s3_object(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start_time)
+
+    async def timed_download_s3_object_async(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return await download_s3_object_async(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start_time)
+
+    s3_util.download_s3_object = timed_download_s3_object
+    s3_async_util.download_s3_object_async = timed_download_s3_object_async
+
+    try:
+        start_time = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            summary = lambda_handler.lambda_handler(event, {})
+        elapsed_time = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(target_path_root, ignore_errors=True)
+
+    p50 = percentile(latencies, 0.50)
+    p99 = percentile(latencies, 0.99)
+    result = {
+        'mode': mode,
+        'max_concurrency': config.max_concurrency,
+        'objects': summary['n_success'],
+        'failures': summary['n_failure'],
+        'seconds': elapsed_time,
+        'objects_per_second': summary['n_success'] / elapsed_time,
+        'mb_per_second': summary['n_bytes'] / elapsed_time / SIZE_UNITS['MB'],
+        'p50_ms': p50 * 1000 if p50 is not None else None,
+        'p99_ms': p99 * 1000 if p99 is not None else None,
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+    print("BENCHMARK_RESULT %s" % (json.dumps(result)))
+
+
+def print_results(results):
+    columns = ['mode', 'max_concurrency', 'objects', 'failures', 'seconds', 'objects_per_second', 'mb_per_second', 'p50_ms', 'p99_ms', 'peak_rss_mb']
+    print("\n" + " | ".join(columns))
+    for result in results:
+        row = []
+        for column in columns:
+            value = result[column]
+            if value is None:
+                row.append("n/a")
+            else:
+                row.append("%.2f" % (value) if isinstance(value, float) else str(value))
+        print(" | ".join(row))
+
+
+def main():
+    # read arguments
+    ap = argparse.ArgumentParser(description="Benchmark download_s3_objects against a local S3 stand-in (moto server).")
+    ap.add_argument("-o", "--objects", default="2000x16KB,200x1MB,2x128MB", help="Objects to seed, as COUNTxSIZE[,COUNTxSIZE...].")
+    ap.add_argument("-m", "--modes", default="sequential,concurrent,ranged,async", help="Comma-separated modes: %s." % (", ".join(BENCHMARK_MODES)))
+    ap.add_argument("-c", "--max-concurrency", type=int, default=32, help="Download workers for the concurrent, ranged and async modes.")
+    ap.add_argument("--part-size", default="16MB", help="Byte range size for the ranged mode.")
+    ap.add_argument("--threshold", default="64MB", help="Object size at which the ranged mode splits objects.")
+    ap.add_argument("--port", type=int, default=5000, help="Port for the local moto server.")
+    ap.add_argument("--endpoint-url", help=argparse.SUPPRESS)
+    ap.add_argument("--run-mode", help=argparse.SUPPRESS)
+    args = vars(ap.parse_args())
+
+    # child process: run one mode against an already seeded endpoint
+    if args['run_mode']:
+        run_mode(args['endpoint_url'], args['run_mode'], args['max_concurrency'],
+            parse_size(args['part_size']), parse_size(args['threshold']))
+        return
+
+    # the stand-in only accepts these dummy credentials; never touch real S3
+    os.environ['AWS_ACCESS_KEY_ID'] = "benchmark"
+    os.environ['AWS_SECRET_ACCESS_KEY'] = "benchmark"
+    os.environ.pop('AWS_PROFILE', None)
+
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=args['port'])
+    server.start()
+    endpoint_url = "http://127.0.0.1:%d" % (args['port'])
+
+    try:
+        seed_objects(endpoint_url, args['objects'])
+
+        results = []
+        for mode in args['modes'].split(","):
+            print("main: Running mode %s ..." % (mode))
+            output = subprocess.run([sys.executable, os.path.abspath(__file__),
+                "--run-mode", mode, "--endpoint-url", endpoint_url,
+                "--max-concurrency", str(args['max_concurrency']),
+                "--part-size", args['part_size'], "--threshold", args['threshold']],
+                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            for line in output.splitlines():
+                if line.startswith("BENCHMARK_RESULT "):
+                    results.append(json.loads(line[len("BENCHMARK_RESULT "):]))
+
+        print_results(results)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
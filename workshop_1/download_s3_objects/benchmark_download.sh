@@ -0,0 +1,6 @@
+#!/bin/bash
+
+echo "[CMD] python benchmark_download.py"
+cd benchmark
+python ./benchmark_download.py "$@"
+cd ..
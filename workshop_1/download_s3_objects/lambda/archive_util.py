@@ -0,0 +1,286 @@
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError, IncompleteReadError
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import io
+import tarfile
+import zipfile
+
+import config
+import metrics_util
+import s3_util
+
+
+# S3 rejects multipart upload parts smaller than this (except the last one)
+MIN_UPLOAD_PART_SIZE = 5 * 1024 * 1024
+
+# objects up to this size are fetched ahead by the worker pool while earlier
+# entries are written; larger objects are streamed when their turn comes
+ARCHIVE_PREFETCH_SIZE = 1024 * 1024
+
+# streamed objects are copied into the archive in chunks of this size
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+
+class S3MultipartWriter:
+    # write-only file object that uploads its content as an S3 multipart upload;
+    # at most multipart_concurrency parts (plus the one being filled) are held in memory
+    def __init__(self, s3, target_bucket_name, target_key):
+        self.s3 = s3
+        self.target_bucket_name = target_bucket_name
+        self.target_key = target_key
+        self.part_size = max(config.multipart_part_size, MIN_UPLOAD_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=config.multipart_concurrency)
+        self.n_bytes = 0
+
+        response = s3.create_multipart_upload(Bucket=target_bucket_name, Key=target_key)
+        self.upload_id = response['UploadId']
+
+    def write(self, data):
+        self.buffer += data
+        self.n_bytes += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        # parts are uploaded as they fill up
+        pass
+
+    def upload_part(self, body):
+        # keep at most multipart_concurrency uploads in flight
+        while len(self.pending) >= config.multipart_concurrency:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+        part_number = len(self.parts) + 1
+        self.parts.append(None)
+        self.pending.add(self.executor.submit(self.upload_part_number, part_number, body))
+
+    def upload_part_number(self, part_number, body):
+        response = self.s3.upload_part(Bucket=self.target_bucket_name, Key=self.target_key,
+            UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        self.parts[part_number - 1] = {'ETag': response['ETag'], 'PartNumber': part_number}
+
+    def close(self):
+        # the last part may be smaller than part_size; an empty upload still needs one part
+        if self.buffer or not self.parts:
+            self.upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        try:
+            for future in self.pending:
+                future.result()
+        finally:
+            self.executor.shutdown()
+
+        self.s3.complete_multipart_upload(Bucket=self.target_bucket_name, Key=self.target_key,
+            UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        self.executor.shutdown()
+        self.s3.abort_multipart_upload(Bucket=self.target_bucket_name, Key=self.target_key, UploadId=self.upload_id)
+
+
+def get_archive_entry_name(source_object_key):
+    # archive paths are relative to the source dataset prefix, like the local layout under target_path_root
+    return source_object_key[len(config.source_dataset_prefix):].lstrip("/") or source_object_key
+
+
+def open_s3_object_body(s3, source_bucket_name, source_object, start=0):
+    # GetObject of the listed version only: an object overwritten since the listing fails
+    # with 412 instead of giving the archive an entry whose size does not match its header
+    get_object_args = {'Bucket': source_bucket_name, 'Key': source_object['Key']}
+    if source_object.get('ETag'):
+        get_object_args['IfMatch'] = source_object['ETag']
+    if start:
+        get_object_args['Range'] = 'bytes=%d-' % start
+    return s3.get_object(**get_object_args)['Body']
+
+
+def read_s3_object_bytes(s3, source_bucket_name, source_object):
+    object_bytes = open_s3_object_body(s3, source_bucket_name, source_object).read()
+    if len(object_bytes) != source_object['Size']:
+        raise IncompleteReadError(actual_bytes=len(object_bytes), expected_bytes=source_object['Size'])
+    return object_bytes
+
+
+def fetch_s3_object_bytes(s3, source_bucket_name, source_object):
+    return s3_util.call_with_stream_retries(read_s3_object_bytes, source_object['Key'],
+        s3, source_bucket_name, source_object)
+
+
+class S3ObjectStream:
+    # read-only file object over a GetObject body for objects streamed into the archive:
+    # a dropped stream is resumed with a ranged GetObject from the last byte read; once the
+    # entry's header is written it cannot be taken back, so if the object cannot be read any
+    # further the rest of the entry is zero-filled to the listed size and the object is failed
+    def __init__(self, s3, source_bucket_name, source_object, body):
+        self.s3 = s3
+        self.source_bucket_name = source_bucket_name
+        self.source_object = source_object
+        self.body = body
+        self.position = 0
+        self.failed = False
+
+    def read_chunk(self, size):
+        if self.body is None:
+            self.body = open_s3_object_body(self.s3, self.source_bucket_name, self.source_object, self.position)
+        try:
+            chunk = self.body.read(size)
+            if not chunk:
+                raise IncompleteReadError(actual_bytes=self.position, expected_bytes=self.source_object['Size'])
+        except s3_util.STREAM_ERRORS:
+            # the next attempt resumes from self.position
+            self.close()
+            raise
+        return chunk
+
+    def read(self, size=-1):
+        remaining = self.source_object['Size'] - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+
+        chunks = []
+        n_read = 0
+        while n_read < size:
+            if self.failed:
+                chunk = bytes(size - n_read)
+            else:
+                try:
+                    chunk = s3_util.call_with_stream_retries(self.read_chunk, self.source_object['Key'], size - n_read)
+                except (ClientError, BotoCoreError) as e:
+                    metrics_util.exception("S3ObjectStream", e, key=self.source_object['Key'], position=self.position)
+                    self.failed = True
+                    self.close()
+                    continue
+            chunks.append(chunk)
+            n_read += len(chunk)
+            self.position += len(chunk)
+
+        return b"".join(chunks)
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+def iter_archive_entries(s3, source_bucket_name, download_tasks):
+    # yield (source_object, file object or None on failure) in listing order;
+    # small objects are fetched ahead by the worker pool so the archive stream never waits on them
+    max_pending = 2 * config.max_concurrency
+    with ThreadPoolExecutor(max_workers=config.max_concurrency) as executor:
+        pending = deque()
+        for source_object, source_object_prefix, source_object_name in download_tasks:
+            future = None
+            if source_object['Size'] <= ARCHIVE_PREFETCH_SIZE:
+                future = executor.submit(fetch_s3_object_bytes, s3, source_bucket_name, source_object)
+            pending.append((source_object, future))
+
+            while len(pending) >= max_pending:
+                yield open_archive_entry(s3, source_bucket_name, *pending.popleft())
+
+        while pending:
+            yield open_archive_entry(s3, source_bucket_name, *pending.popleft())
+
+
+def open_archive_entry(s3, source_bucket_name, source_object, future):
+    try:
+        if future is not None:
+            return source_object, io.BytesIO(future.result())
+        body = s3_util.call_with_stream_retries(open_s3_object_body, source_object['Key'],
+            s3, source_bucket_name, source_object)
+        return source_object, S3ObjectStream(s3, source_bucket_name, source_object, body)
+    except (ClientError, BotoCoreError) as e:
+        metrics_util.exception("open_archive_entry", e, key=source_object['Key'])
+        return source_object, None
+
+
+def add_tar_entry(archive, source_object, source_file):
+    tar_info = tarfile.TarInfo(get_archive_entry_name(source_object['Key']))
+    tar_info.size = source_object['Size']
+    tar_info.mtime = source_object['LastModified'].timestamp()
+    archive.addfile(tar_info, fileobj=source_file)
+
+
+def add_zip_entry(archive, source_object, source_file):
+    zip_info = zipfile.ZipInfo(get_archive_entry_name(source_object['Key']),
+        date_time=source_object['LastModified'].timetuple()[:6])
+    with archive.open(zip_info, 'w', force_zip64=True) as target_file:
+        while True:
+            chunk = source_file.read(ARCHIVE_CHUNK_SIZE)
+            if not chunk:
+                break
+            target_file.write(chunk)
+
+
+def archive_s3_objects(source_bucket_name, download_tasks):
+    # stream every object into one tar or zip archive that is itself written
+    # to target_bucket_name / target_archive_key as a multipart upload; nothing touches local disk
+    s3 = s3_util.get_s3_client()
+    metrics_util.info("archive_s3_objects", output_mode=config.output_mode,
+        target_bucket_name=config.target_bucket_name, target_archive_key=config.target_archive_key)
+
+    writer = S3MultipartWriter(s3, config.target_bucket_name, config.target_archive_key)
+    try:
+        if config.output_mode == "zip":
+            archive = zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED, allowZip64=True)
+            add_entry = add_zip_entry
+        else:
+            archive = tarfile.open(fileobj=writer, mode='w|')
+            add_entry = add_tar_entry
+
+        with archive:
+            for source_object, source_file in iter_archive_entries(s3, source_bucket_name, download_tasks):
+                if source_file is None:
+                    yield source_object, False
+                    continue
+                try:
+                    add_entry(archive, source_object, source_file)
+                finally:
+                    source_file.close()
+                # a streamed object that could not be read to the end is zero-filled in the archive
+                yield source_object, not getattr(source_file, 'failed', False)
+
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+    metrics_util.info("archive_s3_objects_uploaded", target_bucket_name=config.target_bucket_name,
+        target_archive_key=config.target_archive_key, n_bytes=writer.n_bytes, n_parts=len(writer.parts))
+
+
+def copy_s3_object(source_bucket_name, source_object_prefix, source_object_name, source_object=None):
+    # server-side copy: bytes move inside S3 and never pass through this process;
+    # objects above multipart_threshold are copied as parallel UploadPartCopy parts
+    s3 = s3_util.get_s3_client()
+    source_object_key = source_object_name
+    if source_object_prefix:
+        source_object_key = source_object_prefix + "/" + source_object_name
+    # same relative path as the archive entries, under target_prefix
+    target_object_key = get_archive_entry_name(source_object_key)
+    if config.target_prefix:
+        target_object_key = config.target_prefix.rstrip("/") + "/" + target_object_key
+
+    transfer_config = TransferConfig(
+        multipart_threshold=config.multipart_threshold or MIN_UPLOAD_PART_SIZE,
+        multipart_chunksize=max(config.multipart_part_size, MIN_UPLOAD_PART_SIZE),
+        max_concurrency=config.multipart_concurrency)
+    try:
+        s3.copy({'Bucket': source_bucket_name, 'Key': source_object_key},
+            config.target_bucket_name, target_object_key, Config=transfer_config)
+        metrics_util.debug("copy_s3_object", key=source_object_key, target_key=target_object_key)
+
+    except (ClientError, BotoCoreError) as e:
+        metrics_util.exception("copy_s3_object", e, key=source_object_key, target_key=target_object_key)
+        # failure
+        return False
+
+    # success
+    return True
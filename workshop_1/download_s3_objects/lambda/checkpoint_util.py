@@ -0,0 +1,190 @@
+from botocore.exceptions import BotoCoreError, ClientError
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+
+import config
+import filter_util
+import metrics_util
+import s3_util
+
+
+# checkpoint state, returned by lambda_handler and optionally saved to checkpoint_file:
+#   {"bucket": ..., "prefix": ...,
+#    "start_after": key up to which every object is done (listing resumes after it),
+#    "completed_keys": keys after start_after that are already done,
+#    "failed_keys": keys that failed and are retried on resume}
+CHECKPOINT_FILE_NAME = ".s3_checkpoint.json"
+
+
+def get_checkpoint_file_name():
+    if config.checkpoint_file:
+        return config.checkpoint_file
+    if config.output_mode == "local" and config.target_path_root:
+        return os.path.join(config.target_path_root, filter_util.get_shard_file_name(CHECKPOINT_FILE_NAME))
+    return ""
+
+
+def load_checkpoint_state():
+    checkpoint_file_name = get_checkpoint_file_name()
+    if not checkpoint_file_name or not os.path.exists(checkpoint_file_name):
+        metrics_util.info("load_checkpoint_state", path=checkpoint_file_name, message="No checkpoint. Starting from the beginning.")
+        return None
+
+    try:
+        with open(checkpoint_file_name) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (OSError, ValueError) as e:
+        metrics_util.exception("load_checkpoint_state", e, path=checkpoint_file_name)
+        return None
+
+
+def save_checkpoint_state(checkpoint_state):
+    checkpoint_file_name = get_checkpoint_file_name()
+    if not checkpoint_file_name:
+        return False
+
+    # write to a temporary file and rename, so a timeout never leaves a truncated checkpoint
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(checkpoint_file_name)), exist_ok=True)
+        with open(checkpoint_file_name + ".tmp", 'w') as checkpoint_file:
+            json.dump(checkpoint_state, checkpoint_file, separators=(',', ':'))
+        os.replace(checkpoint_file_name + ".tmp", checkpoint_file_name)
+    except OSError as e:
+        metrics_util.exception("save_checkpoint_state", e, path=checkpoint_file_name)
+        return False
+
+    return True
+
+
+def remove_checkpoint_state():
+    checkpoint_file_name = get_checkpoint_file_name()
+    if checkpoint_file_name and os.path.exists(checkpoint_file_name):
+        os.remove(checkpoint_file_name)
+
+
+class DownloadCheckpoint:
+    # tracks which listed objects are done, in listing (key) order, so that a run can stop
+    # before the Lambda timeout and the next one can resume with StartAfter
+    def __init__(self, checkpoint_state=None, context=None):
+        checkpoint_state = checkpoint_state or {}
+        if checkpoint_state and (checkpoint_state.get('bucket') != config.source_bucket_name
+                or checkpoint_state.get('prefix') != config.source_dataset_prefix):
+            metrics_util.warning("DownloadCheckpoint", message="Checkpoint was written for another source. Ignoring it.")
+            checkpoint_state = {}
+
+        self.start_after = checkpoint_state.get('start_after', "")
+        self.retry_keys = set(checkpoint_state.get('failed_keys', []))
+        # a failed key is never done, whatever completed_keys says
+        self.completed_keys = set(checkpoint_state.get('completed_keys', [])) - self.retry_keys
+        self.retried_keys = set()
+        # retry keys whose HeadObject failed: still failed unless the listing downloads them
+        self.head_failed_keys = set()
+        self.failed_keys = set()
+        self.resumed = bool(checkpoint_state)
+        self.interrupted = False
+        self.context = context
+        self.lock = threading.Lock()
+        self.last_save_time = time.time()
+
+        # keys handed to the downloaders -> done, in listing order
+        self.pending = OrderedDict()
+
+    def get_remaining_seconds(self):
+        # the CLI entry point passes a plain dict as context and has no deadline
+        if not hasattr(self.context, 'get_remaining_time_in_millis'):
+            return None
+        return self.context.get_remaining_time_in_millis() / 1000
+
+    def is_out_of_time(self):
+        remaining_seconds = self.get_remaining_seconds()
+        return remaining_seconds is not None and remaining_seconds < config.checkpoint_margin_seconds
+
+    def iter_retry_objects(self, source_bucket_name):
+        # objects that failed in the previous run are fetched again first
+        s3 = s3_util.get_s3_client()
+        with self.lock:
+            retry_keys = sorted(self.retry_keys)
+        for key in retry_keys:
+            try:
+                response = s3.head_object(Bucket=source_bucket_name, Key=key)
+            except (ClientError, BotoCoreError) as e:
+                deleted = isinstance(e, ClientError) and e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+                with self.lock:
+                    # no longer a retry: a key after start_after is downloaded from the listing as usual
+                    self.retry_keys.discard(key)
+                    if not deleted:
+                        self.head_failed_keys.add(key)
+                if deleted:
+                    metrics_util.warning("iter_retry_objects", key=key, message="Deleted since it failed. Not retrying it.")
+                else:
+                    metrics_util.exception("iter_retry_objects", e, key=key)
+                continue
+            yield {
+                'Key': key,
+                'Size': response['ContentLength'],
+                'ETag': response['ETag'],
+                'LastModified': response['LastModified']
+            }
+
+    def track(self, download_tasks):
+        # pass on download tasks that are not done yet; stop early when the Lambda runs out of time
+        for download_task in download_tasks:
+            key = download_task[0]['Key']
+            if key in self.completed_keys:
+                continue
+            if self.is_out_of_time():
+                metrics_util.warning("DownloadCheckpoint", message="Out of time. Stopping before the Lambda timeout.",
+                    remaining_seconds=self.get_remaining_seconds())
+                self.interrupted = True
+                return
+            if key in self.retried_keys:
+                # a failed key after start_after is listed again after its retry
+                continue
+            if key in self.retry_keys:
+                self.retried_keys.add(key)
+            else:
+                with self.lock:
+                    self.pending[key] = False
+            yield download_task
+
+    def complete(self, source_object, success):
+        key = source_object['Key']
+        with self.lock:
+            if success:
+                self.failed_keys.discard(key)
+                self.head_failed_keys.discard(key)
+            else:
+                self.failed_keys.add(key)
+
+            if key not in self.pending:
+                self.retry_keys.discard(key)
+            else:
+                # failed keys count as done here; they are retried from failed_keys
+                self.pending[key] = True
+                while self.pending:
+                    first_key, done = next(iter(self.pending.items()))
+                    if not done:
+                        break
+                    self.pending.popitem(last=False)
+                    self.start_after = first_key
+
+        if time.time() - self.last_save_time >= config.checkpoint_interval:
+            self.last_save_time = time.time()
+            save_checkpoint_state(self.get_state())
+
+    def get_state(self):
+        with self.lock:
+            failed_keys = self.failed_keys | self.retry_keys | self.head_failed_keys
+            # pending keys that failed are done for start_after, but must be retried on resume
+            completed_keys = [key for key, done in self.pending.items() if done and key not in failed_keys]
+            completed_keys += [key for key in self.completed_keys if key > self.start_after and key not in failed_keys]
+            return {
+                'bucket': config.source_bucket_name,
+                'prefix': config.source_dataset_prefix,
+                'start_after': self.start_after,
+                'completed_keys': sorted(completed_keys),
+                'failed_keys': sorted(failed_keys)
+            }
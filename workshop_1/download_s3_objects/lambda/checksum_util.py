@@ -0,0 +1,96 @@
+import base64
+import hashlib
+import zlib
+
+# crc32c is optional: without it, CRC32C checksums fall back to the ETag (MD5)
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+
+class Crc32Hash:
+    # hashlib-style wrapper around zlib.crc32 (or crc32c.crc32c)
+    def __init__(self, crc_function):
+        self.crc_function = crc_function
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = self.crc_function(data, self.crc)
+
+    def digest(self):
+        return (self.crc & 0xffffffff).to_bytes(4, 'big')
+
+
+def new_crc32():
+    return Crc32Hash(zlib.crc32)
+
+
+def new_crc32c():
+    return Crc32Hash(crc32c.crc32c)
+
+
+# S3 additional checksums (GetObject with ChecksumMode=ENABLED), strongest first:
+#   response field -> hash constructor; S3 returns them base64 encoded
+S3_CHECKSUMS = [
+    ('ChecksumSHA256', hashlib.sha256),
+    ('ChecksumSHA1', hashlib.sha1),
+    ('ChecksumCRC32C', new_crc32c if crc32c is not None else None),
+    ('ChecksumCRC32', new_crc32),
+]
+
+# with these encryption modes, the ETag is not the MD5 of the object
+ETAG_NOT_MD5_ENCRYPTION = ('aws:kms', 'aws:kms:dsse')
+
+
+def select_checksum(get_object_response):
+    # pick the expected checksum and a hash to compute it incrementally:
+    #   a full-object S3 additional checksum if present, else the ETag of a
+    #   single-part, non-KMS object (its MD5), else none (size check only)
+    if get_object_response.get('ChecksumType', 'FULL_OBJECT') == 'FULL_OBJECT':
+        for checksum_name, new_hash in S3_CHECKSUMS:
+            expected = get_object_response.get(checksum_name)
+            # composite (per-part) checksums end in "-<number of parts>"
+            if expected and new_hash is not None and '-' not in expected:
+                return checksum_name, expected, new_hash()
+
+    etag = get_object_response.get('ETag', '').strip('"')
+    if (etag and '-' not in etag
+            and get_object_response.get('ServerSideEncryption') not in ETAG_NOT_MD5_ENCRYPTION
+            and 'SSECustomerAlgorithm' not in get_object_response):
+        return 'ETag', etag, hashlib.md5()
+
+    return None, None, None
+
+
+class StreamVerifier:
+    # checks a GetObject body while it is written, so verification costs no extra read pass
+    def __init__(self, get_object_response):
+        self.expected_size = get_object_response.get('ContentLength')
+        self.checksum_name, self.expected, self.hash = select_checksum(get_object_response)
+        self.size = 0
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        if self.hash is not None:
+            self.hash.update(chunk)
+
+    def get_actual(self):
+        if self.hash is None:
+            return None
+        if self.checksum_name == 'ETag':
+            return self.hash.hexdigest()
+        return base64.b64encode(self.hash.digest()).decode('ascii')
+
+    def verify(self):
+        # returns (ok, details)
+        details = {'checksum': self.checksum_name or 'size', 'size': self.size, 'expected_size': self.expected_size}
+        if self.expected_size is not None and self.size != self.expected_size:
+            return False, details
+
+        if self.hash is not None:
+            details['expected'] = self.expected
+            details['actual'] = self.get_actual()
+            return details['expected'] == details['actual'], details
+
+        return True, details
@@ -1,8 +1,78 @@
 # AWS parameters
 profile_name = ""
 region_name = ""
+# optional S3-compatible endpoint (e.g. a local stand-in for benchmarks)
+endpoint_url = ""
 
 # Data locations
 source_bucket_name = ""
 source_dataset_prefix = ""
 target_path_root = ""
+
+# Output mode:
+#   "local": download objects as files under target_path_root
+#   "tar" / "zip": stream objects into one archive uploaded to target_bucket_name / target_archive_key
+#   "s3": server-side copy objects to target_bucket_name under target_prefix
+# only "local" touches local disk
+output_mode = "local"
+target_bucket_name = ""
+target_archive_key = ""
+target_prefix = ""
+
+# Key filters, applied while listing: fnmatch-style include / exclude patterns
+# matched against the key relative to source_dataset_prefix, object size bounds
+# in bytes (0 = no bound), LastModified bounds as ISO 8601 strings (after is
+# inclusive, before exclusive), and hash sharding: with shard_count > 1, this
+# process only transfers the keys of shard shard_index (0 .. shard_count - 1),
+# so shard_count Lambdas can split one dataset with no overlap
+include_patterns = []
+exclude_patterns = []
+min_size = 0
+max_size = 0
+modified_after = ""
+modified_before = ""
+shard_index = 0
+shard_count = 1
+
+# Transfer settings
+max_concurrency = 1
+# when set, downloads run on an asyncio event loop with max_concurrency requests in flight
+use_async = False
+
+# Throttling settings: S3 requests are retried up to max_attempts times with jittered
+# exponential backoff on 503 SlowDown and other transient errors; with adaptive_concurrency,
+# the concurrent and s3 output modes start at min_concurrency transfers in flight and
+# adapt up to max_concurrency (AIMD): growing while latency stays within latency_tolerance
+# x the best seen, and multiplied by concurrency_decrease_factor when S3 throttles
+max_attempts = 6
+adaptive_concurrency = False
+min_concurrency = 1
+concurrency_decrease_factor = 0.5
+latency_tolerance = 2.0
+
+# Large object settings: objects of at least multipart_threshold bytes (0 disables)
+# are fetched as parallel byte ranges of multipart_part_size bytes
+multipart_threshold = 64 * 1024 * 1024
+multipart_part_size = 16 * 1024 * 1024
+multipart_concurrency = 8
+
+# Integrity settings: verify each download against its S3 checksum (SHA256, SHA1,
+# CRC32C, CRC32) or single-part ETag (MD5), computed while the bytes are written;
+# objects are then streamed whole, so multipart_threshold does not apply
+verify_checksums = False
+
+# Checkpoint settings: stop taking new objects when the Lambda has less than
+# checkpoint_margin_seconds left and return a checkpoint to resume from; progress
+# is also saved to checkpoint_file (default: target_path_root/.s3_checkpoint.json
+# in the local output mode) every checkpoint_interval seconds
+checkpoint_file = ""
+checkpoint_margin_seconds = 60
+checkpoint_interval = 30
+
+# Sync settings
+sync = False
+
+# Output settings: JSON-lines records at or above log_level (DEBUG adds per-object detail);
+# transfer counters are reported at most every metrics_interval seconds
+log_level = "INFO"
+metrics_interval = 10
@@ -0,0 +1,106 @@
+from datetime import datetime, timezone
+import fnmatch
+import os
+import re
+import zlib
+
+import config
+import metrics_util
+
+
+# key filters are applied to each listing page as it arrives, before directories
+# are created or downloads start; patterns are fnmatch-style globs matched against
+# the key relative to source_dataset_prefix ("*" also matches "/")
+
+
+def compile_patterns(patterns):
+    # one regex for all patterns, so each key is matched once
+    if not patterns:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+def parse_datetime(value):
+    # ISO 8601 date or date-time; naive values are taken as UTC, like S3 LastModified
+    if not value:
+        return None
+    parsed_datetime = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed_datetime.tzinfo is None:
+        parsed_datetime = parsed_datetime.replace(tzinfo=timezone.utc)
+    return parsed_datetime
+
+
+def get_shard(source_object_key, shard_count):
+    # crc32 of the key, so every process assigns each key to the same shard
+    # (the built-in hash() is randomized per process)
+    return zlib.crc32(source_object_key.encode('utf-8')) % shard_count
+
+
+def get_shard_file_name(file_name):
+    # per-shard state files (".s3_manifest.json" -> ".s3_manifest.0-of-4.json"),
+    # so shards sharing a target_path_root do not overwrite each other
+    if config.shard_count <= 1:
+        return file_name
+    base_name, extension = os.path.splitext(file_name)
+    return "%s.%d-of-%d%s" % (base_name, config.shard_index, config.shard_count, extension)
+
+
+def is_filtered():
+    return bool(config.include_patterns or config.exclude_patterns or config.min_size or config.max_size
+        or config.modified_after or config.modified_before or config.shard_count > 1)
+
+
+class KeyFilter:
+    # selects the objects this process transfers: include/exclude globs, size and
+    # LastModified bounds, and shard_index of shard_count disjoint hash shards
+    def __init__(self):
+        if config.shard_count < 1 or not 0 <= config.shard_index < config.shard_count:
+            raise ValueError("shard_index must be in [0, shard_count): %d, %d" % (config.shard_index, config.shard_count))
+
+        self.include_regex = compile_patterns(config.include_patterns)
+        self.exclude_regex = compile_patterns(config.exclude_patterns)
+        self.min_size = config.min_size
+        self.max_size = config.max_size
+        self.modified_after = parse_datetime(config.modified_after)
+        self.modified_before = parse_datetime(config.modified_before)
+        self.shard_index = config.shard_index
+        self.shard_count = config.shard_count
+        self.n_listed = 0
+        self.n_selected = 0
+
+    def is_selected(self, source_object):
+        # cheapest checks first
+        if self.min_size and source_object['Size'] < self.min_size:
+            return False
+        if self.max_size and source_object['Size'] > self.max_size:
+            return False
+        if self.modified_after is not None and source_object['LastModified'] < self.modified_after:
+            return False
+        if self.modified_before is not None and source_object['LastModified'] >= self.modified_before:
+            return False
+
+        source_object_key = source_object['Key']
+        if self.include_regex is not None or self.exclude_regex is not None:
+            relative_key = source_object_key[len(config.source_dataset_prefix):].lstrip("/")
+            if self.include_regex is not None and not self.include_regex.match(relative_key):
+                return False
+            if self.exclude_regex is not None and self.exclude_regex.match(relative_key):
+                return False
+
+        if self.shard_count > 1 and get_shard(source_object_key, self.shard_count) != self.shard_index:
+            return False
+
+        return True
+
+    def filter_pages(self, source_object_pages):
+        for source_objects in source_object_pages:
+            selected_objects = [source_object for source_object in source_objects if self.is_selected(source_object)]
+            self.n_listed += len(source_objects)
+            self.n_selected += len(selected_objects)
+            metrics_util.debug("filter_page", n_listed=len(source_objects), n_selected=len(selected_objects))
+            yield selected_objects
+
+        metrics_util.info("filter_pages_summary", n_listed=self.n_listed, n_selected=self.n_selected,
+            shard_index=self.shard_index, shard_count=self.shard_count)
@@ -1,11 +1,16 @@
 import argparse
 from datetime import datetime
+import itertools
 import json
 import logging
 from pprint import pformat
 
+import checkpoint_util
 import config
+import filter_util
+import metrics_util
 import s3_util
+import sync_util
 
 
 LOGGER = logging.getLogger(__name__)
@@ -16,54 +21,157 @@ def get_event_vars(event):
     # AWS parameters
     config.profile_name = event["profile_name"]
     config.region_name = event["region_name"]
+    config.endpoint_url = event.get("endpoint_url", "")
 
     # Data locations
     config.source_bucket_name = event["source_bucket_name"]
     config.source_dataset_prefix = event["source_dataset_prefix"]
-    config.target_path_root = event['target_path_root']
+    config.target_path_root = event.get('target_path_root', "")
     
-    # DEBUG
-    print("get_event_vars:")
-    print("profile_name: %s" % (config.profile_name))
-    print("region_name: %s" % (config.region_name))
-    print("source_bucket_name: %s" % (config.source_bucket_name))
-    print("source_dataset_prefix: %s" % (config.source_dataset_prefix))
-    print("target_path_root: %s" % (config.target_path_root))
+    # Output mode (optional)
+    config.output_mode = event.get("output_mode", "local")
+    config.target_bucket_name = event.get("target_bucket_name", "")
+    config.target_archive_key = event.get("target_archive_key", "")
+    config.target_prefix = event.get("target_prefix", "")
+    
+    # Key filters (optional)
+    config.include_patterns = event.get("include_patterns", [])
+    config.exclude_patterns = event.get("exclude_patterns", [])
+    config.min_size = int(event.get("min_size", 0))
+    config.max_size = int(event.get("max_size", 0))
+    config.modified_after = event.get("modified_after", "")
+    config.modified_before = event.get("modified_before", "")
+    config.shard_index = int(event.get("shard_index", 0))
+    config.shard_count = int(event.get("shard_count", 1))
+    
+    # Transfer settings (optional)
+    config.max_concurrency = int(event.get("max_concurrency", 1))
+    config.use_async = bool(event.get("use_async", False))
+    config.multipart_threshold = int(event.get("multipart_threshold", config.multipart_threshold))
+    config.multipart_part_size = int(event.get("multipart_part_size", config.multipart_part_size))
+    config.multipart_concurrency = int(event.get("multipart_concurrency", config.multipart_concurrency))
+    
+    # Throttling settings (optional)
+    config.max_attempts = int(event.get("max_attempts", config.max_attempts))
+    config.adaptive_concurrency = bool(event.get("adaptive_concurrency", False))
+    config.min_concurrency = int(event.get("min_concurrency", config.min_concurrency))
+    config.concurrency_decrease_factor = float(event.get("concurrency_decrease_factor", config.concurrency_decrease_factor))
+    config.latency_tolerance = float(event.get("latency_tolerance", config.latency_tolerance))
+    
+    # Integrity settings (optional)
+    config.verify_checksums = bool(event.get("verify_checksums", False))
+    
+    # Checkpoint settings (optional)
+    config.checkpoint_file = event.get("checkpoint_file", config.checkpoint_file)
+    config.checkpoint_margin_seconds = float(event.get("checkpoint_margin_seconds", config.checkpoint_margin_seconds))
+    config.checkpoint_interval = float(event.get("checkpoint_interval", config.checkpoint_interval))
+    
+    # Sync settings (optional)
+    config.sync = bool(event.get("sync", False))
+    
+    # Output settings (optional)
+    config.log_level = event.get("log_level", config.log_level)
+    config.metrics_interval = float(event.get("metrics_interval", config.metrics_interval))
+    
+    metrics_util.info("get_event_vars", profile_name=config.profile_name, region_name=config.region_name,
+        endpoint_url=config.endpoint_url, source_bucket_name=config.source_bucket_name,
+        source_dataset_prefix=config.source_dataset_prefix, target_path_root=config.target_path_root,
+        output_mode=config.output_mode, target_bucket_name=config.target_bucket_name,
+        target_archive_key=config.target_archive_key, target_prefix=config.target_prefix,
+        include_patterns=config.include_patterns, exclude_patterns=config.exclude_patterns,
+        min_size=config.min_size, max_size=config.max_size, modified_after=config.modified_after,
+        modified_before=config.modified_before, shard_index=config.shard_index, shard_count=config.shard_count,
+        max_concurrency=config.max_concurrency, use_async=config.use_async, max_attempts=config.max_attempts,
+        adaptive_concurrency=config.adaptive_concurrency, min_concurrency=config.min_concurrency,
+        multipart_threshold=config.multipart_threshold, multipart_part_size=config.multipart_part_size,
+        multipart_concurrency=config.multipart_concurrency, verify_checksums=config.verify_checksums,
+        checkpoint_file=config.checkpoint_file, sync=config.sync)
     
 
 def lambda_handler(event, context):
-    # print start datetime
-    now = datetime.now()
-    print("Start dateime: %s" % (now))
-
-    # start
-    print('\nStarting lambda_handler.lambda_handler ...')
-    LOGGER.info("%s", pformat({"Context" : context, "Request": event}))
-
-    # get event variables
+    # get event variables (including the log level) before emitting anything
     get_event_vars(event)
+    
+    # start
+    start_time = datetime.now()
+    metrics_util.info("lambda_handler_start", start_time=start_time)
+    if metrics_util.is_debug():
+        LOGGER.info("%s", pformat({"Context" : context, "Request": event}))
 
-    # get list of source object keys based on source dataset prefix
+    # resume from the checkpoint returned by a previous invocation, or from the checkpoint file;
+    # an archive is written in one piece, so the tar and zip output modes always start over
+    checkpoint = None
+    if config.output_mode in ("local", "s3"):
+        checkpoint_state = event.get("checkpoint")
+        if not checkpoint_state and event.get("resume", False):
+            checkpoint_state = checkpoint_util.load_checkpoint_state()
+        checkpoint = checkpoint_util.DownloadCheckpoint(checkpoint_state, context)
+    
+    # stream source objects based on source dataset prefix, one listing page at a time
     source_bucket_name = config.source_bucket_name
     source_dataset_prefix = config.source_dataset_prefix
-    source_object_keys = s3_util.get_s3_object_keys_by_prefix(source_bucket_name, source_dataset_prefix)
-    print("[DEBUG] download_s3_objects: source_object_keys: %s" % (source_object_keys))
+    start_after = checkpoint.start_after if checkpoint is not None else ""
+    source_object_pages = s3_util.iter_s3_object_pages_by_prefix(source_bucket_name, source_dataset_prefix, start_after)
+    
+    # keep only the objects selected by the key filters and this process's shard;
+    # sync still needs the whole listing to tell which objects were deleted in the source
+    listed_keys = None
+    if filter_util.is_filtered():
+        if config.sync and config.output_mode == "local":
+            listed_keys = set()
+            source_object_pages = sync_util.record_listed_pages(source_object_pages, listed_keys)
+        source_object_pages = filter_util.KeyFilter().filter_pages(source_object_pages)
+    
+    # create target directories once per listing page rather than checking them per object
+    if config.output_mode == "local":
+        s3_util.reset_target_object_prefix_paths()
+        source_objects = s3_util.precreate_target_object_prefix_paths(source_object_pages)
+    else:
+        source_objects = s3_util.iter_objects_from_pages(source_object_pages)
+    
+    # objects that failed in the previous invocation go first
+    if checkpoint is not None and checkpoint.retry_keys:
+        source_objects = itertools.chain(checkpoint.iter_retry_objects(source_bucket_name), source_objects)
+    
+    # download files as they are listed; in sync mode, only new or changed objects
+    # (the sync manifest describes local files, so it only applies to the local output mode)
+    try:
+        if config.sync and config.output_mode == "local":
+            summary = sync_util.sync_s3_objects(source_bucket_name, source_objects, checkpoint=checkpoint,
+                listed_keys=listed_keys)
+        else:
+            summary = s3_util.download_s3_objects(source_bucket_name, source_objects, checkpoint=checkpoint)
+    except Exception:
+        # e.g. the listing failed: keep the progress so far, so a resumed run does not start over
+        if checkpoint is not None:
+            checkpoint.interrupted = True
+            checkpoint_util.save_checkpoint_state(checkpoint.get_state())
+        raise
     
-    # download files
-    s3_util.download_s3_objects(source_bucket_name, source_object_keys)
+    # stopped before the Lambda timeout: return the checkpoint, so the caller can invoke again with it
+    if checkpoint is not None:
+        summary['complete'] = not checkpoint.interrupted
+        if checkpoint.interrupted:
+            summary['checkpoint'] = checkpoint.get_state()
+            checkpoint_util.save_checkpoint_state(summary['checkpoint'])
+            metrics_util.warning("lambda_handler_interrupted", start_after=summary['checkpoint']['start_after'],
+                n_failed_keys=len(summary['checkpoint']['failed_keys']), message="Invoke again with the returned checkpoint to resume.")
+        else:
+            checkpoint_util.remove_checkpoint_state()
     
     # end
-    print('\n... Thaaat\'s all, Folks!')
+    end_time = datetime.now()
+    metrics_util.info("lambda_handler_end", end_time=end_time,
+        elapsed_seconds=(end_time - start_time).total_seconds(), message="Thaaat's all, Folks!")
     
-    # print end datetime
-    now = datetime.now()
-    print("End dateime: %s" % (now))
+    return summary
     
     
 if __name__ == '__main__':
     # read arguments
     ap = argparse.ArgumentParser()
     ap.add_argument("-t", "--task-spec", required=True, help="Task specification.")
+    ap.add_argument("-r", "--resume", action="store_true", help="Resume from the checkpoint file of an interrupted run.")
     args = vars(ap.parse_args())
     print("download_s3_objects: args = %s" % (args))
 
@@ -72,6 +180,8 @@ if __name__ == '__main__':
     f = open(task_spec_file_name)
     event = json.load(f)
     f.close()
+    if args['resume']:
+        event['resume'] = True
     print("download_s3_objects: task_spec = %s" % (event))
 
     # create test context
@@ -0,0 +1,99 @@
+from datetime import datetime
+import json
+import logging
+import threading
+import time
+
+import config
+
+
+# leveled, structured (JSON-lines) output: one JSON object per line on stdout,
+# which CloudWatch Logs stores and queries as-is
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+
+def is_enabled(level):
+    return LEVELS[level] >= LEVELS.get(config.log_level.upper(), LEVELS['INFO'])
+
+
+def is_debug():
+    return is_enabled('DEBUG')
+
+
+def emit(level, event, **fields):
+    if not is_enabled(level):
+        return
+
+    record = {'time': datetime.now().isoformat(), 'level': level, 'event': event}
+    record.update(fields)
+    print(json.dumps(record, default=str))
+
+
+def debug(event, **fields):
+    emit('DEBUG', event, **fields)
+
+
+def info(event, **fields):
+    emit('INFO', event, **fields)
+
+
+def warning(event, **fields):
+    emit('WARNING', event, **fields)
+
+
+def error(event, **fields):
+    emit('ERROR', event, **fields)
+
+
+def exception(event, e, **fields):
+    # one structured error line; the full traceback only at debug level
+    error(event, error_type=type(e).__name__, error=str(e), **fields)
+    if is_debug():
+        logging.exception(e)
+
+
+class TransferMetrics:
+    # thread-safe aggregated counters, reported at most every config.metrics_interval seconds
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        self.n_objects = 0
+        self.n_success = 0
+        self.n_failure = 0
+        self.n_bytes = 0
+
+    def add(self, success, n_bytes=0):
+        with self.lock:
+            self.n_objects += 1
+            if success:
+                self.n_success += 1
+                self.n_bytes += n_bytes
+            else:
+                self.n_failure += 1
+
+            now = time.time()
+            report = now - self.last_report_time >= config.metrics_interval
+            if report:
+                self.last_report_time = now
+
+        if report:
+            info(self.name + "_progress", **self.get_counters())
+
+    def get_counters(self):
+        elapsed_time = max(time.time() - self.start_time, 1e-6)
+        return {
+            'n_objects': self.n_objects,
+            'n_success': self.n_success,
+            'n_failure': self.n_failure,
+            'n_bytes': self.n_bytes,
+            'elapsed_seconds': round(elapsed_time, 3),
+            'objects_per_second': round(self.n_success / elapsed_time, 2),
+            'mb_per_second': round(self.n_bytes / elapsed_time / (1024 * 1024), 2)
+        }
+
+    def report_summary(self):
+        counters = self.get_counters()
+        info(self.name + "_summary", **counters)
+        return counters
@@ -0,0 +1,194 @@
+import asyncio
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError, IncompleteReadError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+
+import checksum_util
+import config
+import metrics_util
+import s3_util
+import throttle_util
+
+# aiobotocore is optional: without it, downloads are offloaded to a bounded thread pool
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    AioConfig = None
+    get_session = None
+
+# s3_util.STREAM_ERRORS, plus the errors aiohttp (an aiobotocore dependency) raises when a body stream drops
+STREAM_ERRORS = (HTTPClientError, BotocoreConnectionError, IncompleteReadError, asyncio.TimeoutError)
+try:
+    from aiohttp import ClientError as AioHttpClientError
+    STREAM_ERRORS += (AioHttpClientError,)
+except ImportError:
+    pass
+
+
+# downloads stream to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# upper bound on OS threads when aiobotocore is not installed
+MAX_FALLBACK_THREADS = 64
+
+
+def get_async_s3_client():
+    metrics_util.info("get_async_s3_client", profile_name=config.profile_name, region_name=config.region_name,
+        endpoint_url=config.endpoint_url, max_pool_connections=config.max_concurrency)
+    
+    session = get_session()
+    if (config.profile_name != ''):
+        session.set_config_variable('profile', config.profile_name)
+    return session.create_client('s3', region_name=config.region_name, endpoint_url=config.endpoint_url or None,
+        config=AioConfig(max_pool_connections=config.max_concurrency, retries=throttle_util.get_retry_config()))
+        
+        
+async def download_s3_object_async(s3, source_bucket_name, source_object, source_object_prefix, source_object_name):
+    # make sure all the directories have been created along target_object_prefix_path
+    target_object_prefix_path = s3_util.create_target_object_prefix_path(source_object_prefix)
+    
+    # stream s3 source object into a local target file
+    target_file_name = os.path.join(target_object_prefix_path, source_object_name)
+    partial_file_name = target_file_name + s3_util.PARTIAL_FILE_SUFFIX
+    try:
+        # a dropped or truncated body stream is fetched again, as in s3_util.call_with_stream_retries
+        for attempt in range(1, s3_util.MAX_STREAM_ATTEMPTS + 1):
+            try:
+                verifier = await stream_s3_object_async(s3, source_bucket_name, source_object['Key'], partial_file_name)
+                break
+            except STREAM_ERRORS as e:
+                if attempt == s3_util.MAX_STREAM_ATTEMPTS:
+                    raise
+                metrics_util.warning("download_s3_object_async", key=source_object['Key'], attempt=attempt, error=str(e))
+                await asyncio.sleep(random.uniform(0, s3_util.STREAM_RETRY_BACKOFF_SECONDS * 2 ** attempt))
+                    
+        if config.verify_checksums:
+            ok, details = verifier.verify()
+            if not ok:
+                s3_util.remove_partial_file(partial_file_name)
+                metrics_util.error("download_s3_object_async", key=source_object['Key'], message="Checksum mismatch.", **details)
+                # failure
+                return False
+                
+        os.replace(partial_file_name, target_file_name)
+                
+    except (ClientError, BotoCoreError, OSError) + STREAM_ERRORS as e:
+        # a per-object failure: the run goes on and the object is retried from the checkpoint
+        metrics_util.exception("download_s3_object_async", e, key=source_object['Key'])
+        s3_util.remove_partial_file(partial_file_name)
+        # failure
+        return False
+        
+    # success
+    return True
+    
+    
+async def stream_s3_object_async(s3, source_bucket_name, source_object_key, partial_file_name):
+    # write the object to partial_file_name; returns its checksum_util.StreamVerifier
+    get_object_args = {'Bucket': source_bucket_name, 'Key': source_object_key}
+    if config.verify_checksums:
+        get_object_args['ChecksumMode'] = 'ENABLED'
+    response = await s3.get_object(**get_object_args)
+    verifier = checksum_util.StreamVerifier(response)
+    async with response['Body'] as stream:
+        with open(partial_file_name, 'wb') as partial_file:
+            while True:
+                chunk = await stream.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if config.verify_checksums:
+                    verifier.update(chunk)
+                partial_file.write(chunk)
+                
+    return verifier
+    
+    
+async def produce_download_tasks(download_tasks, task_queue, n_workers):
+    # pull from the (blocking) listing generator on a helper thread; task_queue is bounded,
+    # so listing pauses whenever the downloaders fall behind
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1) as lister:
+        while True:
+            download_task = await loop.run_in_executor(lister, next, download_tasks, None)
+            if download_task is None:
+                break
+            await task_queue.put(download_task)
+            
+    for _ in range(n_workers):
+        await task_queue.put(None)
+        
+        
+async def consume_download_tasks(download, task_queue, result_queue):
+    while True:
+        download_task = await task_queue.get()
+        if download_task is None:
+            return
+        success = await download(*download_task)
+        await result_queue.put((download_task[0], success))
+        
+        
+async def run_download_pipeline(source_bucket_name, download_tasks, max_concurrency, result_queue):
+    task_queue = asyncio.Queue(maxsize=2 * max_concurrency)
+    
+    async def run_workers(download):
+        workers = [asyncio.ensure_future(produce_download_tasks(download_tasks, task_queue, max_concurrency))]
+        for _ in range(max_concurrency):
+            workers.append(asyncio.ensure_future(consume_download_tasks(download, task_queue, result_queue)))
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+                
+    try:
+        if get_session is not None:
+            metrics_util.info("run_download_pipeline", backend="aiobotocore", n_tasks=max_concurrency)
+            async with get_async_s3_client() as s3:
+                async def download(source_object, source_object_prefix, source_object_name):
+                    return await download_s3_object_async(s3, source_bucket_name, source_object, source_object_prefix, source_object_name)
+                await run_workers(download)
+        else:
+            n_threads = min(max_concurrency, MAX_FALLBACK_THREADS)
+            metrics_util.info("run_download_pipeline", backend="threads", n_tasks=max_concurrency, n_threads=n_threads,
+                message="aiobotocore not installed.")
+            loop = asyncio.get_running_loop()
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                async def download(source_object, source_object_prefix, source_object_name):
+                    return await loop.run_in_executor(executor, s3_util.download_s3_object,
+                        source_bucket_name, source_object_prefix, source_object_name, source_object)
+                await run_workers(download)
+    finally:
+        # tell download_s3_objects_async there are no more results
+        await result_queue.put(None)
+        
+        
+async def create_queue(maxsize):
+    # create the queue inside the loop that will use it
+    return asyncio.Queue(maxsize=maxsize)
+    
+    
+def download_s3_objects_async(source_bucket_name, download_tasks, max_concurrency):
+    # generator of (source_object, success), like the thread-based modes in s3_util;
+    # the event loop only runs while the caller waits for the next result
+    loop = asyncio.new_event_loop()
+    try:
+        result_queue = loop.run_until_complete(create_queue(max_concurrency))
+        pipeline = loop.create_task(run_download_pipeline(source_bucket_name, download_tasks, max_concurrency, result_queue))
+        while True:
+            result = loop.run_until_complete(result_queue.get())
+            if result is None:
+                break
+            yield result
+            
+        # re-raise any error from the pipeline
+        loop.run_until_complete(pipeline)
+    finally:
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
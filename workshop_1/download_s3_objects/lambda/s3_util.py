@@ -1,140 +1,414 @@
-import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError, IncompleteReadError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import json
-import logging
 import os
+import random
+import threading
+import time
 
+import archive_util
+import checksum_util
+import client_util
 import config
+import metrics_util
+import s3_async_util
+import throttle_util
+
+
+# s3 clients are thread-safe, so one client (and its connection pool) is shared
+# by the lister and every download worker instead of being rebuilt per object
+S3_CLIENT = None
+S3_CLIENT_KEY = None
+S3_CLIENT_LOCK = threading.Lock()
+
+# target directories already created by this process; a set lookup replaces a
+# stat (milliseconds on EFS / network mounts) per object
+CREATED_TARGET_OBJECT_PREFIX_PATHS = set()
+
+# downloads are written under this suffix and renamed when complete, so a file at
+# the target name is never a partial one (e.g. after a Lambda timeout)
+PARTIAL_FILE_SUFFIX = ".s3part"
+
+# ranged and verified downloads stream to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# botocore retries the GetObject request but not the read of its body: a stream that
+# drops or ends early (ResponseStreamingError, ConnectionClosedError, ReadTimeoutError,
+# IncompleteReadError, ...) is fetched again up to this many times in total
+STREAM_ERRORS = (HTTPClientError, BotocoreConnectionError, IncompleteReadError)
+MAX_STREAM_ATTEMPTS = 3
+STREAM_RETRY_BACKOFF_SECONDS = 0.5
 
 
 def get_s3_client():
-    print('get_s3_client: profile_name=%s, region_name=%s' % (config.profile_name, config.region_name))
+    global S3_CLIENT, S3_CLIENT_KEY
 
-    p_name = None
-    if (config.profile_name != ''):
-        p_name = config.profile_name
-    session = boto3.Session(profile_name=p_name)
-    s3 = session.client('s3', region_name=config.region_name)
-    return s3
+    # size the connection pool so every download worker (and each of its ranged
+    # downloads) can hold a connection
+    max_pool_connections = max(10, config.max_concurrency * config.multipart_concurrency)
+    s3_client_key = (config.profile_name, config.region_name, config.endpoint_url, max_pool_connections, config.max_attempts)
     
+    with S3_CLIENT_LOCK:
+        if S3_CLIENT is None or S3_CLIENT_KEY != s3_client_key:
+            metrics_util.info("get_s3_client", profile_name=config.profile_name, region_name=config.region_name,
+                endpoint_url=config.endpoint_url, max_pool_connections=max_pool_connections, max_attempts=config.max_attempts)
+
+            S3_CLIENT = client_util.get_client('s3', config.region_name, config.profile_name, config.endpoint_url,
+                max_pool_connections=max_pool_connections, retries=throttle_util.get_retry_config())
+            throttle_util.register_throttle_observer(S3_CLIENT)
+            S3_CLIENT_KEY = s3_client_key
+
+    return S3_CLIENT
     
-def get_s3_object_keys_by_prefix(source_bucket_name, source_dataset_prefix):
+    
+def iter_s3_object_pages_by_prefix(source_bucket_name, source_dataset_prefix, start_after=""):
     s3 = get_s3_client()
     if s3 is None:
-        print('get_s3_object_keys_by_prefix: Failed to get s3 client.')
-        return []
+        metrics_util.error("iter_s3_object_pages_by_prefix", message="Failed to get s3 client.")
+        return
 
-    s3_object_keys = []        
+    # follow continuation tokens and hand back each page as soon as it arrives,
+    # so callers can start downloading before the listing is complete
     try:
-        response = s3.list_objects_v2(Bucket=source_bucket_name, Prefix=source_dataset_prefix)
-        for object in response['Contents']:
-            s3_object_keys.append(object['Key'])
+        paginator = s3.get_paginator('list_objects_v2')
+        paginate_args = {'Bucket': source_bucket_name, 'Prefix': source_dataset_prefix}
+        if start_after:
+            # resume a checkpointed run after the last key it had finished
+            paginate_args['StartAfter'] = start_after
+        for page in paginator.paginate(**paginate_args):
+            source_objects = []
+            for object in page.get('Contents', []):
+                source_objects.append({
+                    'Key': object['Key'],
+                    'Size': object['Size'],
+                    'ETag': object['ETag'],
+                    'LastModified': object['LastModified']
+                })
+            metrics_util.debug("list_page", n_objects=len(source_objects))
+            yield source_objects
 
     except ClientError as e:
-        logging.error("get_source_object_keys_by_prefix: Unexpected error: ")
-        logging.exception(e)
-        return s3_object_keys
+        # a truncated listing must not pass for a complete one: sync would report every
+        # unlisted key as deleted and the checkpoint would be removed as finished
+        metrics_util.exception("iter_s3_object_pages_by_prefix", e, bucket=source_bucket_name, prefix=source_dataset_prefix)
+        raise
+
+
+def iter_objects_from_pages(source_object_pages):
+    # flatten pages into a stream of object summaries (Key, Size, ETag, LastModified)
+    for source_objects in source_object_pages:
+        for source_object in source_objects:
+            yield source_object
+
+
+def iter_s3_objects_by_prefix(source_bucket_name, source_dataset_prefix):
+    return iter_objects_from_pages(iter_s3_object_pages_by_prefix(source_bucket_name, source_dataset_prefix))
+
+
+def get_s3_object_keys_by_prefix(source_bucket_name, source_dataset_prefix):
+    s3_object_keys = []
+    for source_object in iter_s3_objects_by_prefix(source_bucket_name, source_dataset_prefix):
+        s3_object_keys.append(source_object['Key'])
         
     return s3_object_keys
     
     
+def reset_target_object_prefix_paths():
+    # directories from a previous (warm) invocation may have been removed since
+    CREATED_TARGET_OBJECT_PREFIX_PATHS.clear()
+    
+    
 def create_target_object_prefix_path(target_object_prefix):
     # initialize parent path to target path root
     parent_path = config.target_path_root
     
-    # if target directories already exist, we are done
+    # if target directories were already created by this process, we are done
     target_object_prefix_path = os.path.join(parent_path, target_object_prefix)
-    if os.path.exists(target_object_prefix_path):
-        print("[DEBUG] create_target_object_prefix_path: %s exists." % (target_object_prefix_path))
+    if target_object_prefix_path in CREATED_TARGET_OBJECT_PREFIX_PATHS:
         # success
         return target_object_prefix_path
         
     # target_object_prefix_path needs to create one or more directories
     try: 
         os.makedirs(target_object_prefix_path, exist_ok = True) 
-        print("[DEBUG] create_target_object_prefix_path: %s created." % (target_object_prefix_path))
+        CREATED_TARGET_OBJECT_PREFIX_PATHS.add(target_object_prefix_path)
+        metrics_util.debug("create_target_object_prefix_path", path=target_object_prefix_path)
     except OSError as e:
-        logging.error("create_target_object_prefix_path: Unexpected error: ")
-        logging.exception(e)
+        metrics_util.exception("create_target_object_prefix_path", e, path=target_object_prefix_path)
     
     return target_object_prefix_path
     
     
-def download_s3_object(source_bucket_name, source_object_prefix, source_object_name):
+def precreate_target_object_prefix_paths(source_object_pages):
+    # create every directory a listing page needs in one pass, then pass its objects on,
+    # so per-object work in the download loop is just the transfer
+    for source_objects in source_object_pages:
+        target_object_prefixes = set()
+        for source_object in source_objects:
+            target_object_prefixes.add(source_object['Key'].rpartition("/")[0])
+        for target_object_prefix in sorted(target_object_prefixes):
+            create_target_object_prefix_path(target_object_prefix)
+            
+        for source_object in source_objects:
+            yield source_object
+            
+            
+def download_s3_object_range(s3, source_bucket_name, source_object_key, source_object_etag, target_fd, start, end):
+    # fetch bytes [start, end] and write them at the same offset of the preallocated target file
+    get_object_args = {'Bucket': source_bucket_name, 'Key': source_object_key, 'Range': 'bytes=%d-%d' % (start, end)}
+    if source_object_etag:
+        # every range must come from the same version of the object
+        get_object_args['IfMatch'] = source_object_etag
+    response = s3.get_object(**get_object_args)
+    
+    offset = start
+    for chunk in response['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+        offset += os.pwrite(target_fd, chunk, offset)
+    
+    if offset != end + 1:
+        raise IncompleteReadError(actual_bytes=offset - start, expected_bytes=end + 1 - start)
+    
+    
+def call_with_stream_retries(function, source_object_key, *args):
+    # call function (a GetObject plus the read of its body) again when the stream fails;
+    # every attempt rewrites the same bytes, so a retry never leaves mixed content
+    for attempt in range(1, MAX_STREAM_ATTEMPTS + 1):
+        try:
+            return function(*args)
+        except STREAM_ERRORS as e:
+            if attempt == MAX_STREAM_ATTEMPTS:
+                raise
+            metrics_util.warning("call_with_stream_retries", key=source_object_key, attempt=attempt, error=str(e))
+            time.sleep(random.uniform(0, STREAM_RETRY_BACKOFF_SECONDS * 2 ** attempt))
+    
+    
+def download_s3_object_ranged(s3, source_bucket_name, source_object_key, source_object, target_file_name):
+    # split the object into part_size byte ranges and fetch them in parallel
+    source_object_size = source_object['Size']
+    part_size = config.multipart_part_size
+    byte_ranges = []
+    for start in range(0, source_object_size, part_size):
+        byte_ranges.append((start, min(start + part_size, source_object_size) - 1))
+    metrics_util.debug("download_s3_object_ranged", key=source_object_key, size=source_object_size, n_ranges=len(byte_ranges))
+    
+    target_fd = os.open(target_file_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # preallocate the target file so ranges can be written in any order
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(target_fd, 0, source_object_size)
+        else:
+            os.ftruncate(target_fd, source_object_size)
+            
+        with ThreadPoolExecutor(max_workers=config.multipart_concurrency) as executor:
+            futures = []
+            for start, end in byte_ranges:
+                futures.append(executor.submit(call_with_stream_retries, download_s3_object_range, source_object_key,
+                    s3, source_bucket_name, source_object_key, source_object.get('ETag'), target_fd, start, end))
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        os.close(target_fd)
+        
+        
+def download_s3_object_verified(s3, source_bucket_name, source_object_key, target_file_name):
+    # stream the object to disk while hashing it, then compare with its S3 checksum (or ETag)
+    response = s3.get_object(Bucket=source_bucket_name, Key=source_object_key, ChecksumMode='ENABLED')
+    verifier = checksum_util.StreamVerifier(response)
+    with open(target_file_name, 'wb') as target_file:
+        for chunk in response['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+            verifier.update(chunk)
+            target_file.write(chunk)
+            
+    ok, details = verifier.verify()
+    if not ok:
+        # never leave a corrupted file behind for training to pick up
+        metrics_util.error("download_s3_object_verified", key=source_object_key, message="Checksum mismatch.", **details)
+        return False
+        
+    metrics_util.debug("download_s3_object_verified", key=source_object_key, **details)
+    return True
+    
+    
+def download_s3_object(source_bucket_name, source_object_prefix, source_object_name, source_object=None):
+    # source_object is the listing summary (Size, ETag) when known; it selects the ranged path for large objects
     s3 = get_s3_client()
     if s3 is None:
-        print('download_s3_object: Failed to get s3 client.')
+        metrics_util.error("download_s3_object", message="Failed to get s3 client.")
         # failure
         return False
     
     # make sure all the directories have been created along target_object_prefix_path    
     target_object_prefix_path = create_target_object_prefix_path(source_object_prefix)
     
-    # download s3 source object as a local target file
-    target_file_name = target_object_prefix_path + "/" + source_object_name
+    # download s3 source object as a partial file, then move it to the local target file
+    target_file_name = os.path.join(target_object_prefix_path, source_object_name)
+    partial_file_name = target_file_name + PARTIAL_FILE_SUFFIX
+    source_object_key = source_object_name
+    if source_object_prefix:
+        source_object_key = source_object_prefix + "/" + source_object_name
     try:
-        print("[DEBUG] download_s3_object: Open and write to target_file_name: %s" % (target_file_name))
-        with open(target_file_name, 'wb') as target_file:
-            source_object_key = source_object_prefix + "/" + source_object_name
-            s3.download_fileobj(source_bucket_name, source_object_key, target_file)
-        target_file.close()
-        print("[DEBUG] download_s3_object: Close target_file_name: %s" % (target_file_name))
+        if config.verify_checksums:
+            # ranges arrive out of order and cannot be hashed as one stream, so verified
+            # downloads of large objects also take the single-stream path
+            success = call_with_stream_retries(download_s3_object_verified, source_object_key,
+                s3, source_bucket_name, source_object_key, partial_file_name)
+        elif (source_object is not None and config.multipart_threshold > 0
+                and source_object['Size'] >= config.multipart_threshold):
+            # every range is checked for its exact length
+            download_s3_object_ranged(s3, source_bucket_name, source_object_key, source_object, partial_file_name)
+            success = True
+        else:
+            with open(partial_file_name, 'wb') as partial_file:
+                s3.download_fileobj(source_bucket_name, source_object_key, partial_file)
+            success = True
+            
+        if success:
+            os.replace(partial_file_name, target_file_name)
         
-    except ClientError as e:
-        logging.error("download_s3_object: Unexpected error: ")
-        logging.exception(e)
+    except (ClientError, BotoCoreError, IOError) as e:
+        # a per-object failure: the run goes on and the object is retried from the checkpoint
+        metrics_util.exception("download_s3_object", e, key=source_object_key)
+        success = False
+        
+    if not success:
+        remove_partial_file(partial_file_name)
         # failure
         return False
     
     # success
     return True
     
+    
+def remove_partial_file(partial_file_name):
+    try:
+        os.remove(partial_file_name)
+    except OSError:
+        pass
+    
         
-def download_s3_objects(source_bucket_name, source_object_keys):
-    # foreach source object key, download source object
-    n_source_objects = 0
-    n_success = 0
-    n_failure = 0
-    for source_object_key in source_object_keys:
-        print("==")
-        print("[DEBUG] download_s3_objects: Downloading source_object_key: %s" % (source_object_key))
-        
-        # parse source object key into an array of source object path elements
-        source_object_path_elements = source_object_key.split("/")
-        n_source_object_path_elements = len(source_object_path_elements)
-        print("[DEBUG] download_s3_objects: source_object_path_elements: %s" % (source_object_path_elements))
-        print("[DEBUG] download_s3_objects: source_object_path_elements has %d elements." % (n_source_object_path_elements))
-        
-        # set input to download_s3_object
-        source_bucket_name = config.source_bucket_name
-        # source_object_prefix:
-        #   handle boundary conditions of:
-        #       1 element: bucket-level object name
-        #       2 elements: bucket-level prefix + object name
-        #   str.join() can handle 2 or more prefix levels
+def split_s3_object_key(source_object_key):
+    # parse source object key into an array of source object path elements
+    source_object_path_elements = source_object_key.split("/")
+    n_source_object_path_elements = len(source_object_path_elements)
+    
+    # source_object_prefix:
+    #   handle boundary conditions of:
+    #       1 element: bucket-level object name
+    #       2 elements: bucket-level prefix + object name
+    #   str.join() can handle 2 or more prefix levels
+    source_object_prefix = ""
+    if n_source_object_path_elements == 1:
         source_object_prefix = ""
-        if n_source_object_path_elements == 1:
-            source_object_prefix = ""
-        elif n_source_object_path_elements == 2:
-            source_object_prefix = source_object_path_elements[0]
-        else:
-            source_object_prefix = "/".join(source_object_path_elements[0:-1])
-        source_object_name = source_object_path_elements[-1]
-        print("[DEBUG] download_s3_objects: source_bucket_name: %s" % (source_bucket_name))
-        print("[DEBUG] download_s3_objects: source_object_prefix: %s" % (source_object_prefix))
-        print("[DEBUG] download_s3_objects: source_object_name: %s" % (source_object_name))
+    elif n_source_object_path_elements == 2:
+        source_object_prefix = source_object_path_elements[0]
+    else:
+        source_object_prefix = "/".join(source_object_path_elements[0:-1])
+    source_object_name = source_object_path_elements[-1]
+    
+    return source_object_prefix, source_object_name
+    
+    
+def iter_download_tasks(source_bucket_name, source_objects):
+    # foreach source object, yield the inputs to download_s3_object
+    debug = metrics_util.is_debug()
+    for source_object in source_objects:
+        source_object_key = source_object['Key']
+        source_object_prefix, source_object_name = split_s3_object_key(source_object_key)
+        if debug:
+            metrics_util.debug("download_task", bucket=source_bucket_name, key=source_object_key,
+                prefix=source_object_prefix, name=source_object_name, size=source_object['Size'])
         
         if not source_object_name:
-            print("[DEBUG] download_s3_objects: source_object_name is empty. Skip.")
+            if debug:
+                metrics_util.debug("download_task_skipped", key=source_object_key, reason="source_object_name is empty")
         else:
-            n_source_objects += 1
-            success = download_s3_object(source_bucket_name, source_object_prefix, source_object_name)
-            if success:
-                n_success += 1
-            else:
-                n_failure += 1
+            yield source_object, source_object_prefix, source_object_name
+            
+            
+def download_s3_objects_sequentially(source_bucket_name, download_tasks, transfer=None):
+    # download (or transfer, e.g. copy) one source object at a time
+    transfer = transfer or download_s3_object
+    for source_object, source_object_prefix, source_object_name in download_tasks:
+        success = transfer(source_bucket_name, source_object_prefix, source_object_name, source_object)
+        yield source_object, success
+        
+        
+def download_s3_objects_concurrently(source_bucket_name, download_tasks, max_concurrency, transfer=None, controller=None):
+    # download (or transfer, e.g. copy) with a bounded pool of workers sharing one s3 client;
+    # at most 2 * max_concurrency downloads are queued so a long listing is not
+    # buffered in memory ahead of the workers
+    # with a controller (throttle_util.AdaptiveConcurrency), only controller.get_limit() are in flight
+    transfer = transfer or download_s3_object
+    max_pending = 2 * max_concurrency
+    if controller is not None:
+        transfer = throttle_util.adapt_transfer(transfer, controller)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = {}
+        for source_object, source_object_prefix, source_object_name in download_tasks:
+            future = executor.submit(transfer, source_bucket_name, source_object_prefix, source_object_name, source_object)
+            pending[future] = source_object
             
-    print("download_s3_objects: Processed %d source objects." % (n_source_objects))
-    print("download_s3_objects: %d succeeded; %d failed." % (n_success, n_failure))
+            while len(pending) >= (controller.get_limit() if controller is not None else max_pending):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+                    
+        for future in as_completed(pending):
+            yield pending[future], future.result()
+            
+            
+def download_s3_objects(source_bucket_name, source_objects, on_result=None, checkpoint=None):
+    # foreach source object, download source object
+    # source_objects may be a generator, so downloads start while listing continues
+    # on_result(source_object, success) is called from this thread as each download completes
+    # checkpoint (checkpoint_util.DownloadCheckpoint) skips finished objects and stops before a timeout
+    metrics = metrics_util.TransferMetrics("download_s3_objects")
+    
+    download_tasks = iter_download_tasks(source_bucket_name, source_objects)
+    if checkpoint is not None:
+        download_tasks = checkpoint.track(download_tasks)
+        
+    # adapt the number of transfers in flight to S3 throttling and latency
+    controller = None
+    if config.adaptive_concurrency and config.max_concurrency > 1 and not config.use_async:
+        controller = throttle_util.AdaptiveConcurrency(config.min_concurrency, config.max_concurrency)
+        
+    if config.output_mode in ("tar", "zip"):
+        results = archive_util.archive_s3_objects(source_bucket_name, download_tasks)
+    elif config.output_mode == "s3":
+        metrics_util.info("download_s3_objects", mode="s3_copy", max_concurrency=config.max_concurrency,
+            adaptive_concurrency=controller is not None, target_bucket_name=config.target_bucket_name,
+            target_prefix=config.target_prefix)
+        results = download_s3_objects_concurrently(source_bucket_name, download_tasks, config.max_concurrency,
+            transfer=archive_util.copy_s3_object, controller=controller)
+    elif config.use_async:
+        metrics_util.info("download_s3_objects", mode="async", max_concurrency=config.max_concurrency)
+        results = s3_async_util.download_s3_objects_async(source_bucket_name, download_tasks, config.max_concurrency)
+    elif config.max_concurrency > 1:
+        metrics_util.info("download_s3_objects", mode="concurrent", max_concurrency=config.max_concurrency,
+            adaptive_concurrency=controller is not None)
+        results = download_s3_objects_concurrently(source_bucket_name, download_tasks, config.max_concurrency,
+            controller=controller)
+    else:
+        metrics_util.info("download_s3_objects", mode="sequential")
+        results = download_s3_objects_sequentially(source_bucket_name, download_tasks)
+        
+    # the s3 client's retry hook reports throttling to the running controller
+    throttle_util.CONTROLLER = controller
+    try:
+        for source_object, success in results:
+            if on_result is not None:
+                on_result(source_object, success)
+            if checkpoint is not None:
+                checkpoint.complete(source_object, success)
+            metrics.add(success, source_object['Size'])
+    finally:
+        throttle_util.CONTROLLER = None
+        
+    summary = metrics.report_summary()
+    if controller is not None:
+        summary.update(controller.get_counters())
+        metrics_util.info("adaptive_concurrency_summary", **controller.get_counters())
+    return summary
     
-    
\ No newline at end of file
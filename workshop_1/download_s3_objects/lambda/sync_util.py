@@ -0,0 +1,135 @@
+import json
+import os
+
+import config
+import filter_util
+import metrics_util
+import s3_util
+
+
+# manifest of objects already downloaded under target_path_root:
+#   {"bucket": ..., "prefix": ..., "objects": {key: [size, etag, last_modified]}}
+MANIFEST_FILE_NAME = ".s3_manifest.json"
+
+# deleted keys listed in the sync summary; all of them are logged at debug level
+MAX_REPORTED_DELETED_KEYS = 20
+
+
+def get_manifest_file_name():
+    return os.path.join(config.target_path_root, filter_util.get_shard_file_name(MANIFEST_FILE_NAME))
+    
+    
+def get_manifest_entry(source_object):
+    return [source_object['Size'], source_object['ETag'], source_object['LastModified'].isoformat()]
+    
+    
+def load_manifest():
+    manifest_file_name = get_manifest_file_name()
+    if not os.path.exists(manifest_file_name):
+        metrics_util.info("load_manifest", path=manifest_file_name, message="Not found. Starting with an empty manifest.")
+        return {}
+        
+    try:
+        with open(manifest_file_name) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        metrics_util.exception("load_manifest", e, path=manifest_file_name)
+        return {}
+        
+    # a manifest written for another bucket or prefix says nothing about this one
+    if manifest.get('bucket') != config.source_bucket_name or manifest.get('prefix') != config.source_dataset_prefix:
+        metrics_util.warning("load_manifest", path=manifest_file_name, message="Written for another source. Ignoring it.")
+        return {}
+        
+    metrics_util.info("load_manifest", path=manifest_file_name, n_entries=len(manifest['objects']))
+    return manifest['objects']
+    
+    
+def save_manifest(manifest_objects):
+    manifest_file_name = get_manifest_file_name()
+    manifest = {
+        'bucket': config.source_bucket_name,
+        'prefix': config.source_dataset_prefix,
+        'objects': manifest_objects
+    }
+    
+    # write to a temporary file and rename, so a crash never leaves a truncated manifest
+    try:
+        os.makedirs(config.target_path_root, exist_ok=True)
+        with open(manifest_file_name + ".tmp", 'w') as manifest_file:
+            json.dump(manifest, manifest_file, separators=(',', ':'))
+        os.replace(manifest_file_name + ".tmp", manifest_file_name)
+    except OSError as e:
+        metrics_util.exception("save_manifest", e, path=manifest_file_name)
+        return False
+        
+    metrics_util.info("save_manifest", path=manifest_file_name, n_entries=len(manifest_objects))
+    return True
+    
+    
+def is_unchanged(source_object, manifest_objects):
+    manifest_entry = manifest_objects.get(source_object['Key'])
+    if manifest_entry is None or manifest_entry != get_manifest_entry(source_object):
+        return False
+        
+    # the local copy must still be there with the expected size
+    target_file_name = os.path.join(config.target_path_root, source_object['Key'])
+    try:
+        return os.stat(target_file_name).st_size == source_object['Size']
+    except OSError:
+        return False
+        
+        
+def record_listed_pages(source_object_pages, listed_keys):
+    # remember every listed key, before the key filters run, so objects a filter
+    # excludes are not reported as deleted in the source
+    for source_objects in source_object_pages:
+        listed_keys.update(source_object['Key'] for source_object in source_objects)
+        yield source_objects
+
+
+def iter_changed_objects(source_objects, manifest_objects, seen_keys):
+    # only pass on new or changed objects; remember every listed key for deletion reporting
+    for source_object in source_objects:
+        seen_keys.add(source_object['Key'])
+        if not is_unchanged(source_object, manifest_objects):
+            yield source_object
+            
+            
+def sync_s3_objects(source_bucket_name, source_objects, checkpoint=None, listed_keys=None):
+    # listed_keys: every key in the unfiltered listing (see record_listed_pages), when source_objects is filtered
+    manifest_objects = load_manifest()
+    seen_keys = set()
+    
+    def on_result(source_object, success):
+        if success:
+            manifest_objects[source_object['Key']] = get_manifest_entry(source_object)
+        else:
+            manifest_objects.pop(source_object['Key'], None)
+            
+    changed_objects = iter_changed_objects(source_objects, manifest_objects, seen_keys)
+    try:
+        summary = s3_util.download_s3_objects(source_bucket_name, changed_objects, on_result=on_result, checkpoint=checkpoint)
+    except Exception:
+        # keep what was downloaded so far; the listing is incomplete, so skip deletion reporting
+        save_manifest(manifest_objects)
+        raise
+        
+    # report objects that were downloaded before but no longer exist in the source;
+    # a resumed or interrupted run has not seen the whole listing, so it cannot tell
+    deleted_keys = []
+    if checkpoint is None or not (checkpoint.resumed or checkpoint.interrupted):
+        if listed_keys is None:
+            listed_keys = seen_keys
+        deleted_keys = sorted(key for key in manifest_objects if key not in listed_keys)
+    for key in deleted_keys:
+        metrics_util.debug("deleted_in_source", key=key)
+        del manifest_objects[key]
+    save_manifest(manifest_objects)
+        
+    summary['n_unchanged'] = len(seen_keys) - summary['n_objects']
+    summary['n_deleted'] = len(deleted_keys)
+    metrics_util.info("sync_s3_objects_summary", n_listed=len(seen_keys), n_unchanged=summary['n_unchanged'],
+        n_deleted=summary['n_deleted'], deleted_keys_sample=deleted_keys[:MAX_REPORTED_DELETED_KEYS])
+    
+    return summary
@@ -0,0 +1,133 @@
+import threading
+import time
+
+import config
+import metrics_util
+
+
+# S3 answers too many requests per prefix with 503 SlowDown; other AWS services use these codes
+THROTTLING_ERROR_CODES = {
+    'SlowDown', 'ServiceUnavailable', 'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException', 'TooManyRequests',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException'
+}
+THROTTLING_STATUS_CODES = (429, 503)
+
+# throttling errors from requests that were already in flight belong to the same
+# congestion event, so concurrency is decreased at most once per this interval
+THROTTLE_COOLDOWN_SECONDS = 1.0
+
+# weight of the newest sample in the latency moving average
+LATENCY_EWMA_WEIGHT = 0.1
+
+# the best latency seen drifts up by this factor per sample, so the baseline
+# follows a bucket or network that has become slower for good
+BASE_LATENCY_DRIFT = 1.001
+
+# the controller of the running transfer; the s3 client's retry hook reports throttling to it
+CONTROLLER = None
+
+
+def get_retry_config():
+    # botocore "legacy" retries (its default) back off for random() * 2 ** (attempt - 1) seconds
+    # on throttling and transient errors; unlike "standard" mode, there is no client-wide
+    # retry quota that stops retrying throttled requests when S3 throttles for a while
+    return {'mode': 'legacy', 'total_max_attempts': config.max_attempts}
+
+
+def is_throttling_response(response):
+    if response is None:
+        return False
+    http_response, parsed_response = response
+    error_code = parsed_response.get('Error', {}).get('Code')
+    return http_response.status_code in THROTTLING_STATUS_CODES or error_code in THROTTLING_ERROR_CODES
+
+
+def on_needs_retry(response=None, **kwargs):
+    # botocore emits needs-retry after every request attempt; this only observes
+    # (returns None), the retry handler registered after it decides on the backoff
+    controller = CONTROLLER
+    if controller is not None and is_throttling_response(response):
+        controller.on_throttle()
+
+
+def register_throttle_observer(client):
+    client.meta.events.register_first('needs-retry.s3', on_needs_retry, unique_id='throttle_util.on_needs_retry')
+
+
+class AdaptiveConcurrency:
+    # AIMD concurrency limit between min_concurrency and max_concurrency:
+    #   slow start: +1 per completed transfer (doubling every round trip) until the first congestion signal
+    #   additive increase: +1 per limit completed transfers (one per round trip)
+    #   multiplicative decrease: * concurrency_decrease_factor on throttling
+    # growth pauses while the (size-normalized) latency is above latency_tolerance x the best seen
+    def __init__(self, min_concurrency, max_concurrency):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = float(self.min_concurrency)
+        self.slow_start = True
+        self.latency = None
+        self.base_latency = None
+        self.last_decrease_time = 0.0
+        self.n_throttled = 0
+        self.n_decreases = 0
+        self.lock = threading.Lock()
+
+    def get_limit(self):
+        return int(self.limit)
+
+    def on_throttle(self):
+        with self.lock:
+            self.n_throttled += 1
+            now = time.time()
+            if now - self.last_decrease_time < THROTTLE_COOLDOWN_SECONDS:
+                return
+            self.last_decrease_time = now
+            self.slow_start = False
+            self.limit = max(self.min_concurrency, self.limit * config.concurrency_decrease_factor)
+            self.n_decreases += 1
+            limit = self.get_limit()
+
+        metrics_util.info("adaptive_concurrency_decrease", limit=limit, n_throttled=self.n_throttled)
+
+    def on_complete(self, latency, n_bytes):
+        # per-request latency grows with object size; normalize it to roughly a 1MB request
+        normalized_latency = latency / (1 + n_bytes / (1024 * 1024))
+        with self.lock:
+            if self.latency is None:
+                self.latency = self.base_latency = normalized_latency
+            else:
+                self.latency += LATENCY_EWMA_WEIGHT * (normalized_latency - self.latency)
+                self.base_latency = min(self.latency, self.base_latency * BASE_LATENCY_DRIFT)
+
+            if self.latency > config.latency_tolerance * self.base_latency:
+                # requests queue up somewhere (network, disk, S3): more concurrency adds latency, not throughput
+                self.slow_start = False
+                return
+
+            previous_limit = self.get_limit()
+            if self.slow_start:
+                self.limit += 1
+            else:
+                self.limit += 1 / self.limit
+            self.limit = min(self.limit, self.max_concurrency)
+            limit = self.get_limit()
+
+        if limit != previous_limit:
+            metrics_util.debug("adaptive_concurrency_increase", limit=limit, slow_start=self.slow_start)
+
+    def get_counters(self):
+        return {'concurrency_limit': self.get_limit(), 'n_throttled': self.n_throttled, 'n_concurrency_decreases': self.n_decreases}
+
+
+def adapt_transfer(transfer, controller):
+    # time each successful transfer for the controller's latency signal
+    def adaptive_transfer(source_bucket_name, source_object_prefix, source_object_name, source_object=None):
+        start_time = time.perf_counter()
+        success = transfer(source_bucket_name, source_object_prefix, source_object_name, source_object)
+        if success:
+            n_bytes = source_object['Size'] if source_object is not None else 0
+            controller.on_complete(time.perf_counter() - start_time, n_bytes)
+        return success
+
+    return adaptive_transfer
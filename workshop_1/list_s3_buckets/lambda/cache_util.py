@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import config
+import metrics_util
+
+
+# results cached for cache_ttl seconds: in memory, which a warm Lambda container keeps
+# between invocations, and optionally as JSON files under cache_dir (e.g. /tmp), which
+# also survives a cold start in a container that is reused
+CACHE = {}
+CACHE_LOCK = threading.Lock()
+
+
+def get_cache_key(name):
+    # results depend on the account (profile) and the region they were fetched from
+    return "%s|%s|%s" % (name, config.profile_name, config.region_name)
+
+
+def get_cache_file_name(cache_key):
+    return os.path.join(config.cache_dir, "%s.json" % (hashlib.sha256(cache_key.encode('utf-8')).hexdigest()[:32]))
+
+
+def load_cache_file(cache_key):
+    cache_file_name = get_cache_file_name(cache_key)
+    try:
+        with open(cache_file_name) as cache_file:
+            entry = json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        metrics_util.exception("load_cache_file", e, path=cache_file_name)
+        return None
+
+    # a hash collision or a file from another account must not be served
+    if entry.get('key') != cache_key:
+        return None
+    return entry['expires_at'], entry['value']
+
+
+def save_cache_file(cache_key, expires_at, value):
+    cache_file_name = get_cache_file_name(cache_key)
+    try:
+        os.makedirs(config.cache_dir, exist_ok=True)
+        with open(cache_file_name + ".tmp", 'w') as cache_file:
+            json.dump({'key': cache_key, 'expires_at': expires_at, 'value': value}, cache_file, default=str)
+        os.replace(cache_file_name + ".tmp", cache_file_name)
+    except OSError as e:
+        metrics_util.exception("save_cache_file", e, path=cache_file_name)
+
+
+def get_cached(name, compute, refresh=False):
+    # return compute()'s result, computed at most once per cache_ttl seconds;
+    # compute() returns None when it failed: that is not cached, so the call is retried on the next invocation
+    if config.cache_ttl <= 0:
+        return compute()
+
+    cache_key = get_cache_key(name)
+    now = time.time()
+    if not refresh:
+        with CACHE_LOCK:
+            entry = CACHE.get(cache_key)
+        if entry is not None and entry[0] > now:
+            metrics_util.info("cache_hit", name=name, source="memory", expires_in_seconds=round(entry[0] - now, 1))
+            return entry[1]
+
+        if config.cache_dir:
+            entry = load_cache_file(cache_key)
+            if entry is not None and entry[0] > now:
+                metrics_util.info("cache_hit", name=name, source="file", expires_in_seconds=round(entry[0] - now, 1))
+                with CACHE_LOCK:
+                    CACHE[cache_key] = entry
+                return entry[1]
+
+    metrics_util.info("cache_miss", name=name, refresh=refresh)
+    value = compute()
+    if value is not None:
+        expires_at = time.time() + config.cache_ttl
+        with CACHE_LOCK:
+            CACHE[cache_key] = (expires_at, value)
+        if config.cache_dir:
+            save_cache_file(cache_key, expires_at, value)
+
+    return value
@@ -1,3 +1,19 @@
 # AWS parameters
 profile_name = ""
 region_name = ""
+
+# Inventory settings: with inventory set, every bucket's region, object count and size
+# (CloudWatch storage metrics, or a listing sample when a bucket has none yet) and tags
+# are fetched with max_concurrency workers and one client per region
+inventory = False
+max_concurrency = 16
+inventory_listing_fallback = True
+
+# Cache settings: bucket names and inventory results are reused for cache_ttl seconds
+# (0 disables caching), in memory and, when cache_dir is set (e.g. "/tmp/list_s3_buckets_cache"),
+# as JSON files there; refresh_cache in the event forces a new listing
+cache_ttl = 300
+cache_dir = ""
+
+# Output settings: JSON-lines records at or above log_level (DEBUG adds per-bucket detail)
+log_level = "INFO"
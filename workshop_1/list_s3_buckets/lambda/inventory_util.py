@@ -0,0 +1,217 @@
+from botocore.exceptions import ClientError
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import client_util
+import config
+import metrics_util
+import s3_util
+
+
+# bucket inventory: region, object count / size estimates and tags of every bucket,
+# fetched concurrently with one s3 and one cloudwatch client per region
+
+# S3 publishes storage metrics to CloudWatch once a day
+STORAGE_METRIC_PERIOD = 24 * 60 * 60
+STORAGE_METRIC_LOOKBACK = timedelta(days=3)
+
+# get_metric_data accepts at most this many queries per call
+MAX_METRIC_DATA_QUERIES = 500
+
+# buckets without CloudWatch storage metrics (e.g. created today) are estimated
+# from the first listing page of up to this many keys
+LISTING_SAMPLE_KEYS = 1000
+
+INVENTORY_COLUMNS = ['name', 'region', 'creation_date', 'n_objects', 'size_bytes', 'estimate', 'tags']
+
+
+def get_regional_client(service_name, region_name):
+    # clients are thread-safe and bound to a region, so one per (service, region) is shared by all workers
+    return client_util.get_client(service_name, region_name, config.profile_name,
+        max_pool_connections=max(10, config.max_concurrency))
+
+
+def get_bucket_region(bucket_name):
+    # GetBucketLocation answers from any region; None means us-east-1 and "EU" is the legacy eu-west-1
+    s3 = get_regional_client('s3', config.region_name)
+    try:
+        location = s3.get_bucket_location(Bucket=bucket_name).get('LocationConstraint')
+    except ClientError as e:
+        metrics_util.exception("get_bucket_region", e, bucket=bucket_name)
+        return None
+
+    if not location:
+        return 'us-east-1'
+    if location == 'EU':
+        return 'eu-west-1'
+    return location
+
+
+def get_bucket_tags(bucket_name, region_name):
+    s3 = get_regional_client('s3', region_name)
+    try:
+        tag_set = s3.get_bucket_tagging(Bucket=bucket_name)['TagSet']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchTagSet':
+            metrics_util.exception("get_bucket_tags", e, bucket=bucket_name)
+        return {}
+
+    return dict((tag['Key'], tag['Value']) for tag in tag_set)
+
+
+def get_bucket_listing_estimate(bucket_name, region_name):
+    # exact when the bucket fits in one listing page, otherwise a lower bound
+    s3 = get_regional_client('s3', region_name)
+    try:
+        response = s3.list_objects_v2(Bucket=bucket_name, MaxKeys=LISTING_SAMPLE_KEYS)
+    except ClientError as e:
+        metrics_util.exception("get_bucket_listing_estimate", e, bucket=bucket_name)
+        return None, None, None
+
+    contents = response.get('Contents', [])
+    estimate = "listing_partial" if response.get('IsTruncated') else "listing"
+    return len(contents), sum(object['Size'] for object in contents), estimate
+
+
+def get_region_storage_metrics(region_name, bucket_names):
+    # latest daily BucketSizeBytes (summed over storage types) and NumberOfObjects of
+    # the region's buckets: one list_metrics pass plus batched get_metric_data calls,
+    # instead of a get_metric_statistics call per bucket and metric
+    cloudwatch = get_regional_client('cloudwatch', region_name)
+    bucket_names = set(bucket_names)
+    metrics = []
+    try:
+        paginator = cloudwatch.get_paginator('list_metrics')
+        for metric_name in ('BucketSizeBytes', 'NumberOfObjects'):
+            for page in paginator.paginate(Namespace='AWS/S3', MetricName=metric_name):
+                for metric in page['Metrics']:
+                    dimensions = dict((dimension['Name'], dimension['Value']) for dimension in metric['Dimensions'])
+                    if dimensions.get('BucketName') in bucket_names:
+                        metrics.append((dimensions['BucketName'], metric))
+    except ClientError as e:
+        metrics_util.exception("get_region_storage_metrics", e, region=region_name)
+        return {}
+
+    end_time = datetime.now(timezone.utc)
+    start_time = end_time - STORAGE_METRIC_LOOKBACK
+    storage_metrics = defaultdict(dict)
+    for batch_start in range(0, len(metrics), MAX_METRIC_DATA_QUERIES):
+        batch = metrics[batch_start:batch_start + MAX_METRIC_DATA_QUERIES]
+        queries = []
+        for query_index, (bucket_name, metric) in enumerate(batch):
+            queries.append({
+                'Id': "m%d" % (query_index),
+                'MetricStat': {'Metric': metric, 'Period': STORAGE_METRIC_PERIOD, 'Stat': 'Average'},
+                'ReturnData': True
+            })
+        try:
+            paginator = cloudwatch.get_paginator('get_metric_data')
+            for page in paginator.paginate(MetricDataQueries=queries, StartTime=start_time, EndTime=end_time,
+                    ScanBy='TimestampDescending'):
+                for result in page['MetricDataResults']:
+                    if not result['Values']:
+                        continue
+                    bucket_name, metric = batch[int(result['Id'][1:])]
+                    # values are newest first
+                    value = int(result['Values'][0])
+                    bucket_metrics = storage_metrics[bucket_name]
+                    bucket_metrics[metric['MetricName']] = bucket_metrics.get(metric['MetricName'], 0) + value
+        except ClientError as e:
+            metrics_util.exception("get_region_storage_metrics", e, region=region_name)
+
+    metrics_util.debug("get_region_storage_metrics", region=region_name, n_buckets=len(bucket_names),
+        n_metrics=len(metrics), n_buckets_with_metrics=len(storage_metrics))
+    return storage_metrics
+
+
+def get_s3_bucket_inventory(buckets):
+    # buckets: list_buckets entries (Name, CreationDate); returns one row per bucket
+    inventory = {}
+    for bucket in buckets:
+        inventory[bucket['Name']] = {
+            'name': bucket['Name'],
+            'region': None,
+            'creation_date': bucket['CreationDate'].isoformat() if bucket.get('CreationDate') else None,
+            'n_objects': None,
+            'size_bytes': None,
+            'estimate': None,
+            'tags': {}
+        }
+
+    with ThreadPoolExecutor(max_workers=config.max_concurrency) as executor:
+        # 1. regions: per-bucket calls, all in parallel
+        for bucket_name, region_name in zip(inventory, executor.map(get_bucket_region, list(inventory))):
+            inventory[bucket_name]['region'] = region_name
+
+        bucket_names_by_region = defaultdict(list)
+        for bucket_name, row in inventory.items():
+            if row['region'] is not None:
+                bucket_names_by_region[row['region']].append(bucket_name)
+
+        # 2. storage metrics per region and tags per bucket, in parallel
+        metrics_futures = dict((region_name, executor.submit(get_region_storage_metrics, region_name, bucket_names))
+            for region_name, bucket_names in bucket_names_by_region.items())
+        tags_futures = dict((bucket_name, executor.submit(get_bucket_tags, bucket_name, row['region']))
+            for bucket_name, row in inventory.items() if row['region'] is not None)
+
+        listing_futures = {}
+        for region_name, metrics_future in metrics_futures.items():
+            storage_metrics = metrics_future.result()
+            for bucket_name in bucket_names_by_region[region_name]:
+                row = inventory[bucket_name]
+                bucket_metrics = storage_metrics.get(bucket_name, {})
+                if bucket_metrics:
+                    row['n_objects'] = bucket_metrics.get('NumberOfObjects')
+                    row['size_bytes'] = bucket_metrics.get('BucketSizeBytes')
+                    row['estimate'] = "cloudwatch"
+                elif config.inventory_listing_fallback:
+                    # 3. no metrics yet: sample the listing instead
+                    listing_futures[bucket_name] = executor.submit(get_bucket_listing_estimate, bucket_name, region_name)
+
+        for bucket_name, tags_future in tags_futures.items():
+            inventory[bucket_name]['tags'] = tags_future.result()
+        for bucket_name, listing_future in listing_futures.items():
+            row = inventory[bucket_name]
+            row['n_objects'], row['size_bytes'], row['estimate'] = listing_future.result()
+
+    return list(inventory.values())
+
+
+def get_s3_bucket_inventory_table():
+    # list the buckets and return their inventory as a compact table; None if listing them failed
+    s3_buckets = s3_util.get_s3_buckets()
+    if s3_buckets is None:
+        return None
+        
+    inventory = get_s3_bucket_inventory(s3_buckets)
+    metrics_util.info("get_s3_bucket_inventory", num_s3_buckets=len(inventory),
+        num_regions=len(set(row['region'] for row in inventory if row['region'] is not None)))
+    if metrics_util.is_debug():
+        for row in inventory:
+            metrics_util.debug("s3_bucket_inventory_row", **row)
+
+    return get_inventory_table(inventory)
+
+
+def get_inventory_table(inventory):
+    # compact table: column names once, then one list of values per bucket
+    return {
+        'columns': INVENTORY_COLUMNS,
+        'rows': [[row[column] for column in INVENTORY_COLUMNS] for row in inventory]
+    }
+
+
+def format_inventory_table(inventory_table):
+    # fixed-width text rendering for the command line
+    lines = [inventory_table['columns']]
+    for row in inventory_table['rows']:
+        line = []
+        for value in row:
+            if isinstance(value, dict):
+                value = ",".join("%s=%s" % (key, value[key]) for key in sorted(value))
+            line.append("" if value is None else str(value))
+        lines.append(line)
+
+    widths = [max(len(line[index]) for line in lines) for index in range(len(lines[0]))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip() for line in lines)
@@ -4,7 +4,10 @@ import json
 import logging
 from pprint import pformat
 
+import cache_util
 import config
+import inventory_util
+import metrics_util
 import s3_util
 
 
@@ -17,44 +20,67 @@ def get_event_vars(event):
     config.profile_name = event["profile_name"]
     config.region_name = event["region_name"]
     
-    # DEBUG
-    print("get_event_vars:")
-    print("profile_name: %s" % (config.profile_name))
-    print("region_name: %s" % (config.region_name))
+    # Inventory settings (optional)
+    config.inventory = bool(event.get("inventory", False))
+    config.max_concurrency = int(event.get("max_concurrency", config.max_concurrency))
+    config.inventory_listing_fallback = bool(event.get("inventory_listing_fallback", config.inventory_listing_fallback))
+    
+    # Cache settings (optional)
+    config.cache_ttl = float(event.get("cache_ttl", config.cache_ttl))
+    config.cache_dir = event.get("cache_dir", config.cache_dir)
+    
+    # Output settings (optional)
+    config.log_level = event.get("log_level", config.log_level)
+    
+    metrics_util.info("get_event_vars", profile_name=config.profile_name, region_name=config.region_name,
+        inventory=config.inventory, max_concurrency=config.max_concurrency, cache_ttl=config.cache_ttl,
+        cache_dir=config.cache_dir)
     
 
 def lambda_handler(event, context):
-    # print start datetime
-    now = datetime.now()
-    print("Start dateime: %s" % (now))
-
-    # start
-    print('\nStarting lambda_handler.lambda_handler ...')
-    LOGGER.info("%s", pformat({"Context" : context, "Request": event}))
-
-    # get event variables
+    # get event variables (including the log level) before emitting anything
     get_event_vars(event)
     
-    # get s3 bucket names
-    s3_bucket_names = s3_util.get_s3_bucket_names()
-    num_s3_bucket_names = len(s3_bucket_names)
+    # start
+    start_time = datetime.now()
+    metrics_util.info("lambda_handler_start", start_time=start_time)
+    if metrics_util.is_debug():
+        LOGGER.info("%s", pformat({"Context" : context, "Request": event}))
     
-    print("S3 Bucket Names: ")
-    print(s3_bucket_names)
-    print("Total # of S3 Buckets: %d" % (num_s3_bucket_names))
+    # results change rarely, so both modes are served from the cache while it is fresh
+    refresh_cache = bool(event.get("refresh_cache", False))
+    result = None
+    if config.inventory:
+        # get s3 bucket inventory: region, size, object count and tags per bucket
+        result = cache_util.get_cached("s3_bucket_inventory", inventory_util.get_s3_bucket_inventory_table, refresh_cache)
+        if result is None:
+            # listing the buckets failed (and was logged)
+            result = inventory_util.get_inventory_table([])
+        
+        metrics_util.info("s3_bucket_inventory", num_s3_buckets=len(result['rows']))
+    else:
+        # get s3 bucket names
+        s3_bucket_names = cache_util.get_cached("s3_bucket_names", s3_util.get_s3_bucket_names, refresh_cache)
+        if s3_bucket_names is None:
+            # listing the buckets failed (and was logged)
+            s3_bucket_names = []
+        num_s3_bucket_names = len(s3_bucket_names)
+        
+        metrics_util.info("s3_bucket_names", s3_bucket_names=s3_bucket_names, num_s3_bucket_names=num_s3_bucket_names)
     
     # end
-    print('\n... Thaaat\'s all, Folks!')
-
-    # print end datetime
-    now = datetime.now()
-    print("End dateime: %s" % (now))
+    end_time = datetime.now()
+    metrics_util.info("lambda_handler_end", end_time=end_time,
+        elapsed_seconds=(end_time - start_time).total_seconds(), message="Thaaat's all, Folks!")
+    
+    return result
 
 
 if __name__ == '__main__':
     # read arguments
     ap = argparse.ArgumentParser()
     ap.add_argument("-t", "--task-spec", required=True, help="Task specification.")
+    ap.add_argument("-i", "--inventory", action="store_true", help="Print the bucket inventory table.")
     args = vars(ap.parse_args())
     print("list_s3_buckets: args = %s" % (args))
 
@@ -63,12 +89,16 @@ if __name__ == '__main__':
     f = open(task_spec_file_name)
     event = json.load(f)
     f.close()
+    if args['inventory']:
+        event['inventory'] = True
     print("list_s3_buckets: task_spec = %s" % (event))
 
     # create test context
     context = {}
 
     # Execute test
-    lambda_handler(event, context)
+    result = lambda_handler(event, context)
+    if result is not None:
+        print(inventory_util.format_inventory_table(result))
     
     
\ No newline at end of file
@@ -0,0 +1,51 @@
+from datetime import datetime
+import json
+import logging
+
+import config
+
+
+# leveled, structured (JSON-lines) output: one JSON object per line on stdout,
+# which CloudWatch Logs stores and queries as-is
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+
+def is_enabled(level):
+    return LEVELS[level] >= LEVELS.get(config.log_level.upper(), LEVELS['INFO'])
+
+
+def is_debug():
+    return is_enabled('DEBUG')
+
+
+def emit(level, event, **fields):
+    if not is_enabled(level):
+        return
+
+    record = {'time': datetime.now().isoformat(), 'level': level, 'event': event}
+    record.update(fields)
+    print(json.dumps(record, default=str))
+
+
+def debug(event, **fields):
+    emit('DEBUG', event, **fields)
+
+
+def info(event, **fields):
+    emit('INFO', event, **fields)
+
+
+def warning(event, **fields):
+    emit('WARNING', event, **fields)
+
+
+def error(event, **fields):
+    emit('ERROR', event, **fields)
+
+
+def exception(event, e, **fields):
+    # one structured error line; the full traceback only at debug level
+    error(event, error_type=type(e).__name__, error=str(e), **fields)
+    if is_debug():
+        logging.exception(e)
+
@@ -1,39 +1,64 @@
-import boto3
 from botocore.exceptions import ClientError
 import json
-import logging
+import threading
 
+import client_util
 import config
+import metrics_util
+
+
+# a warm Lambda container reuses the module-level client (and its open connections)
+# instead of building a session and client on every invocation
+S3_CLIENT = None
+S3_CLIENT_KEY = None
+S3_CLIENT_LOCK = threading.Lock()
 
 
 def get_s3_client():
-    print('get_s3_client: profile_name=%s, region_name=%s' % (config.profile_name, config.region_name))
-
-    p_name = None
-    if (config.profile_name != ''):
-        p_name = config.profile_name
-    session = boto3.Session(profile_name=p_name)
-    s3 = session.client('s3', region_name=config.region_name)
-    return s3
+    global S3_CLIENT, S3_CLIENT_KEY
+
+    s3_client_key = (config.profile_name, config.region_name)
+    with S3_CLIENT_LOCK:
+        if S3_CLIENT is None or S3_CLIENT_KEY != s3_client_key:
+            metrics_util.info("get_s3_client", profile_name=config.profile_name, region_name=config.region_name)
+
+            S3_CLIENT = client_util.get_client('s3', config.region_name, config.profile_name)
+            S3_CLIENT_KEY = s3_client_key
+
+    return S3_CLIENT
     
 
-def get_s3_bucket_names():
+def get_s3_buckets():
+    # list_buckets entries (Name, CreationDate); None if the call failed, so the
+    # failure is not cached as an account without buckets
     s3 = get_s3_client()
     if s3 is None:
-        print('get_s3_buckets: Failed to get s3 client.')
-        return []
+        metrics_util.error("get_s3_buckets", message="Failed to get s3 client.")
+        return None
         
-    s3_bucket_names = []
+    s3_buckets = []
     try:
         response = s3.list_buckets()
-        print('[DEBUG] get_s3_bucket_names: s3.list_buckets() response: %s' % (response))
+        metrics_util.debug("list_buckets_response", response=response)
         if 'Buckets' in response:
-            for bucket in response['Buckets']:
-                s3_bucket_names.append(bucket['Name'])
+            s3_buckets = response['Buckets']
                 
     except ClientError as e:
-        logging.error("get_s3_bucket_names: unexpected error: ")
-        logging.exception(e)
+        metrics_util.exception("get_s3_buckets", e)
+        return None
+        
+    return s3_buckets
+    
+
+def get_s3_bucket_names():
+    # None if listing the buckets failed
+    s3_buckets = get_s3_buckets()
+    if s3_buckets is None:
+        return None
+        
+    s3_bucket_names = []
+    for bucket in s3_buckets:
+        s3_bucket_names.append(bucket['Name'])
         
     return s3_bucket_names
 
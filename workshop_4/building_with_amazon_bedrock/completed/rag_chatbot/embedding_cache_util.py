@@ -0,0 +1,108 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+
+#persistent embedding cache: one SQLite file of float32 blobs keyed by a hash of
+#(model id, dimension, normalized text, image), so unchanged documents and repeated
+#queries are never sent to Bedrock twice; least recently used entries are evicted
+
+MAX_ENTRIES = 500000 #about 2GB of 1024-dimension float32 embeddings
+EVICTION_FRACTION = 0.1 #evict this share of MAX_ENTRIES at once, so eviction runs rarely
+
+EMBEDDING_CACHES = {}
+EMBEDDING_CACHES_LOCK = threading.Lock()
+
+
+def normalize_text(text):
+    #the same text with different unicode forms or whitespace gets the same key
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def get_cache_key(model_id, dimension, text=None, image=None):
+    key_hash = hashlib.sha256()
+    for part in (model_id, str(dimension), normalize_text(text) if text else "", image or ""):
+        key_hash.update(part.encode('utf-8'))
+        key_hash.update(b"\0")
+    return key_hash.hexdigest()
+
+
+class EmbeddingCache(): #thread-safe; the embedding engine's workers share one connection
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL") #readers in other processes do not block writers
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model_id TEXT, dimension INTEGER, embedding BLOB, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get(self, model_id, dimension, text=None, image=None):
+        key = get_cache_key(model_id, dimension, text, image)
+        with self.lock:
+            row = self.connection.execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.connection.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        return array('f', row[0]).tolist()
+
+    def put(self, model_id, dimension, embedding, text=None, image=None):
+        key = get_cache_key(model_id, dimension, text, image)
+        blob = array('f', embedding).tobytes()
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO embeddings (key, model_id, dimension, embedding, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, model_id, dimension, blob, time.time()))
+            if cursor.rowcount > 0:
+                self.count += 1
+            if self.count > self.max_entries:
+                self.evict()
+
+    def evict(self):
+        #callers hold self.lock; drop the least recently used entries
+        n_evicted = max(1, int(self.max_entries * EVICTION_FRACTION))
+        self.connection.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (n_evicted,))
+        self.count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_or_compute(self, model_id, dimension, compute, text=None, image=None):
+        #compute() is only called (and its result stored) on a cache miss
+        embedding = self.get(model_id, dimension, text, image)
+        if embedding is None:
+            embedding = compute()
+            self.put(model_id, dimension, embedding, text, image)
+        return embedding
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': self.count,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print(f"Embedding cache: {stats['entries']} entries, {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)")
+
+
+def get_embedding_cache(path):
+    #one cache (and connection) per file for the whole process
+    with EMBEDDING_CACHES_LOCK:
+        if path not in EMBEDDING_CACHES:
+            EMBEDDING_CACHES[path] = EmbeddingCache(path)
+        return EMBEDDING_CACHES[path]
@@ -1,10 +1,21 @@
 import itertools
-import boto3
+import json
+import os
+import threading
 import chromadb
+import client_util
+import embedding_cache_util
 from chromadb.utils.embedding_functions import AmazonBedrockEmbeddingFunction
 
 MAX_MESSAGES = 20
 
+TEXT_EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"
+TEXT_EMBEDDING_DIMENSION = 1024 #Titan Text Embeddings v2 default, as used for the collections
+EMBEDDING_CACHE_PATH = "../../data/embedding_cache.sqlite" #shared with the data scripts
+
+COLLECTIONS = {} #(absolute path, collection name) -> collection handle, see get_collection
+COLLECTIONS_LOCK = threading.Lock()
+
 class ChatMessage(): #create a class that can store image and text messages
     def __init__(self, role, text):
         self.role = role
@@ -13,8 +24,38 @@ class ChatMessage(): #create a class that can store image and text messages
 #
 
 def get_collection(path, collection_name):
-    session = boto3.Session()
-    embedding_function = AmazonBedrockEmbeddingFunction(session=session, model_name="amazon.titan-embed-text-v2:0")
+    #the client, embedding function and collection handle are created once per (path, collection name)
+    #and shared by every tool call and thread; invalidate_collections drops them
+    collection_key = (os.path.abspath(path), collection_name)
+    
+    collection = COLLECTIONS.get(collection_key)
+    if collection is None:
+        with COLLECTIONS_LOCK:
+            collection = COLLECTIONS.get(collection_key)
+            if collection is None:
+                collection = open_collection(path, collection_name)
+                COLLECTIONS[collection_key] = collection
+    
+    return collection
+
+#
+
+def invalidate_collections(path=None, collection_name=None):
+    #drops the cached handles (all of them, a path's, or one collection's), e.g. after a collection was rebuilt
+    with COLLECTIONS_LOCK:
+        for collection_key in list(COLLECTIONS):
+            if path is not None and collection_key[0] != os.path.abspath(path):
+                continue
+            if collection_name is not None and collection_key[1] != collection_name:
+                continue
+            del COLLECTIONS[collection_key]
+
+#
+
+def open_collection(path, collection_name):
+    #the embedding function creates its Bedrock client from the shared session, under the client lock
+    embedding_function = client_util.call_with_session(
+        lambda session: AmazonBedrockEmbeddingFunction(session=session, model_name="amazon.titan-embed-text-v2:0"))
     
     client = chromadb.PersistentClient(path=path)
     collection = client.get_collection(collection_name, embedding_function=embedding_function)
@@ -23,10 +64,34 @@ def get_collection(path, collection_name):
 
 #
 
+def invoke_text_embedding_model(text):
+    bedrock = client_util.get_client('bedrock-runtime') #reuses a shared Bedrock client
+    
+    response = bedrock.invoke_model(
+        body=json.dumps({ "inputText": text }), 
+        modelId=TEXT_EMBEDDING_MODEL_ID, 
+        accept="application/json",
+        contentType="application/json"
+    )
+    
+    response_body = json.loads(response['body'].read())
+    return response_body['embedding']
+
+#
+
+def get_text_embedding(text):
+    #repeated queries are served from the embedding cache instead of Bedrock
+    embedding_cache = embedding_cache_util.get_embedding_cache(EMBEDDING_CACHE_PATH)
+    
+    return embedding_cache.get_or_compute(TEXT_EMBEDDING_MODEL_ID, TEXT_EMBEDDING_DIMENSION,
+        lambda: invoke_text_embedding_model(text), text=text)
+
+#
+
 def get_vector_search_results(collection, question):
     
     results = collection.query(
-        query_texts=[question],
+        query_embeddings=[get_text_embedding(question)], #same model as the collection's embedding function
         n_results=4
     )
     
@@ -94,7 +159,7 @@ def process_tool(response_message, messages, bedrock, tool_list):
             
             if tool_use_block['name'] == 'get_amazon_bedrock_information':
                 
-                collection = get_collection("../../data/chroma", "bedrock_faqs_collection")
+                collection = get_collection("../../data/chroma", "bedrock_faqs_collection") #cached handle
                 
                 query = tool_use_block['input']['query']
                 
@@ -152,8 +217,7 @@ def process_tool(response_message, messages, bedrock, tool_list):
 #
 
 def chat_with_model(message_history, new_text=None):
-    session = boto3.Session()
-    bedrock = session.client(service_name='bedrock-runtime') #creates a Bedrock client
+    bedrock = client_util.get_client('bedrock-runtime') #reuses a shared Bedrock client
     
     tool_list = get_tools()
     
@@ -1,4 +1,4 @@
-import boto3
+import client_util
 
 def get_summary(input_text):
     
@@ -21,8 +21,7 @@ def get_summary(input_text):
         ]
     }
     
-    session = boto3.Session()
-    bedrock = session.client(service_name='bedrock-runtime')
+    bedrock = client_util.get_client('bedrock-runtime') #reuses a shared Bedrock client
     
     response = bedrock.converse(
         modelId="us.anthropic.claude-3-7-sonnet-20250219-v1:0",
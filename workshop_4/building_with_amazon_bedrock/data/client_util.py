@@ -0,0 +1,60 @@
+import boto3
+from botocore.config import Config
+import copy
+import threading
+
+
+# shared AWS clients: building a boto3 session and client costs tens of milliseconds and
+# every new client opens new (TLS) connections, so each session (per profile) and each
+# client (per service, region, profile, endpoint and config) is created once and reused;
+# clients are thread-safe, sessions are not, so sessions are only used under CLIENTS_LOCK
+SESSIONS = {}
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+# botocore.config.Config defaults for every client; callers override them per client
+DEFAULT_CONFIG_ARGS = {
+    # enough connections for a thread pool sharing the client
+    'max_pool_connections': 50,
+    # keep idle pooled connections alive between calls
+    'tcp_keepalive': True,
+    # exponential backoff with jitter on throttling and transient errors
+    'retries': {'mode': 'standard', 'max_attempts': 5},
+}
+
+
+def get_session_locked(profile_name):
+    # callers hold CLIENTS_LOCK
+    session = SESSIONS.get(profile_name)
+    if session is None:
+        session = boto3.Session(profile_name=profile_name)
+        SESSIONS[profile_name] = session
+    return session
+
+
+def call_with_session(function, profile_name=None):
+    # for libraries that take a session and create their clients from it (e.g. chromadb's
+    # AmazonBedrockEmbeddingFunction): function(session) runs under CLIENTS_LOCK, so it must not call get_client
+    with CLIENTS_LOCK:
+        return function(get_session_locked(profile_name or None))
+
+
+def get_client(service_name, region_name=None, profile_name=None, endpoint_url=None, **config_args):
+    # config_args are botocore.config.Config arguments on top of DEFAULT_CONFIG_ARGS
+    client_config_args = dict(DEFAULT_CONFIG_ARGS)
+    client_config_args.update(config_args)
+    client_key = (service_name, region_name or None, profile_name or None, endpoint_url or None,
+        repr(sorted(client_config_args.items())))
+
+    client = CLIENTS.get(client_key)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(client_key)
+            if client is None:
+                session = get_session_locked(profile_name or None)
+                # botocore normalizes the retries dict in place, so it gets a copy
+                client = session.client(service_name, region_name=region_name or None,
+                    endpoint_url=endpoint_url or None, config=Config(**copy.deepcopy(client_config_args)))
+                CLIENTS[client_key] = client
+
+    return client
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import time
+from array import array
+import embedding_store_util
+
+#bulk loading of prefetched embeddings into chroma collections: one collection.add call per
+#batch instead of per item, so loading is bound by index building rather than call overhead;
+#later loads only write the items whose content hash changed and delete the ones that are gone
+
+BATCH_SIZE = 5000 #items per collection.add call, capped at the client's maximum batch size
+CONTENT_HASH_KEY = "content_hash" #metadata key holding get_content_hash(item), compared by sync_collection
+
+
+def get_max_batch_size(client):
+    #chromadb 0.5 has get_max_batch_size(), 0.4 a max_batch_size property
+    if hasattr(client, 'get_max_batch_size'):
+        return client.get_max_batch_size()
+
+    return getattr(client, 'max_batch_size', BATCH_SIZE)
+
+
+def get_content_hash(item):
+    #hash of the document, metadata and float32 embedding, the same whichever file format they came from
+    content_hash = hashlib.sha256()
+    metadata = dict((key, value) for key, value in item['metadata'].items() if key != CONTENT_HASH_KEY)
+    content_hash.update(json.dumps([item['document'], metadata], sort_keys=True).encode('utf-8'))
+    content_hash.update(array('f', item['embedding']).tobytes())
+    return content_hash.hexdigest()
+
+
+def iter_hashed_items(items):
+    #the items with their content hash added to their metadata
+    for item in items:
+        item['metadata'] = dict(item['metadata'], **{CONTENT_HASH_KEY: get_content_hash(item)})
+        yield item
+
+
+def get_collection_hashes(collection, batch_size):
+    #id -> stored content hash (None for items loaded without one) of every item in the collection
+    stored_hashes = {}
+    offset = 0
+
+    while True:
+        result = collection.get(include=['metadatas'], limit=batch_size, offset=offset)
+
+        for item_id, metadata in zip(result['ids'], result['metadatas']):
+            stored_hashes[item_id] = (metadata or {}).get(CONTENT_HASH_KEY)
+
+        if len(result['ids']) < batch_size:
+            return stored_hashes
+
+        offset += batch_size
+
+
+def iter_batches(items, batch_size):
+    #yields (records, embedding rows) of up to batch_size items from any iterable of items
+    records = []
+    embedding_rows = []
+
+    for item in items:
+        records.append(item)
+        embedding_rows.append(item['embedding'])
+
+        if len(records) == batch_size:
+            yield records, embedding_rows
+            records = []
+            embedding_rows = []
+
+    if records:
+        yield records, embedding_rows
+
+
+def add_batches(collection, batches, n_items=None, upsert=False):
+    #adds (or upserts) every (records, embedding rows) batch to the collection, reporting the throughput
+    write = collection.upsert if upsert else collection.add
+    action = "Upserted" if upsert else "Added"
+    start_time = time.time()
+    n_added = 0
+
+    for records, embedding_rows in batches:
+        write(
+            ids=[str(item['id']) for item in records],
+            documents=[item['document'] for item in records],
+            metadatas=[item['metadata'] for item in records],
+            embeddings=embedding_rows
+        )
+
+        n_added += len(records)
+        elapsed_time = time.time() - start_time
+        total = f"/{n_items}" if n_items is not None else ""
+        print(f"{action} {n_added}{total} items in {collection.name} ({n_added / elapsed_time:.1f} items/s)")
+
+    return n_added
+
+
+def load_collection(collection, source_name, batch_size=BATCH_SIZE, max_batch_size=None):
+    #streams the items of <source_name>.npy + <source_name>.meta.json, <source_name>.json or
+    #<source_name>.jsonl into the collection in batches; memory holds one batch, whatever the corpus size
+    if max_batch_size:
+        batch_size = min(batch_size, max_batch_size)
+
+    items = iter_hashed_items(embedding_store_util.iter_items(source_name))
+
+    return add_batches(collection, iter_batches(items, batch_size), embedding_store_util.get_item_count(source_name))
+
+
+def sync_collection(collection, source_name, batch_size=BATCH_SIZE, max_batch_size=None):
+    #upserts the source items that are new or changed since the last load (by id and content hash)
+    #and deletes the ids no longer in the source, so a refresh costs in proportion to the change
+    if max_batch_size:
+        batch_size = min(batch_size, max_batch_size)
+
+    stored_hashes = get_collection_hashes(collection, batch_size)
+    source_ids = set()
+
+    def iter_changed_items():
+        for item in iter_hashed_items(embedding_store_util.iter_items(source_name)):
+            source_ids.add(str(item['id']))
+            if stored_hashes.get(str(item['id'])) != item['metadata'][CONTENT_HASH_KEY]:
+                yield item
+
+    n_upserted = add_batches(collection, iter_batches(iter_changed_items(), batch_size), upsert=True)
+
+    deleted_ids = [item_id for item_id in stored_hashes if item_id not in source_ids]
+    for batch_start in range(0, len(deleted_ids), batch_size):
+        collection.delete(ids=deleted_ids[batch_start:batch_start + batch_size])
+
+    print(f"Synced {collection.name}: {n_upserted} upserted, {len(source_ids) - n_upserted} unchanged, {len(deleted_ids)} deleted")
+
+    return n_upserted, len(deleted_ids)
@@ -0,0 +1,224 @@
+import json
+import os
+
+#numpy is optional for writing (chromadb, which the populate scripts use, depends on it):
+#without it, embeddings are saved in the JSON format
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#embedding files: <name>.npy holds all embeddings as one float32 matrix (one row per item),
+#<name>.meta.json holds the ids, documents and metadata in the same order;
+#about 4x smaller than JSON float lists, and the matrix is memory-mapped instead of parsed
+
+#prefetch jobs append each embedded item to <name>.jsonl as it completes (the resume point after
+#a crash), then convert it to OUTPUT_FORMAT one item at a time and remove it
+
+READ_SIZE = 1024 * 1024 #characters read at a time when streaming a JSON file
+
+OUTPUT_FORMAT = "npy" #or "json" for the original <name>.json list of items with embeddings, or "jsonl" to keep <name>.jsonl
+
+
+def get_matrix_path(name):
+    return f"{name}.npy"
+
+
+def get_meta_path(name):
+    return f"{name}.meta.json"
+
+
+def get_json_path(name):
+    return f"{name}.json"
+
+
+def get_jsonl_path(name):
+    return f"{name}.jsonl"
+
+
+def load_completed_ids(name):
+    #ids already in <name>.jsonl; a last line cut short by a crash is truncated away
+    completed_ids = set()
+    if not os.path.exists(get_jsonl_path(name)):
+        return completed_ids
+
+    with open(get_jsonl_path(name), 'rb+') as jsonl_file:
+        valid_size = 0
+        for line in jsonl_file:
+            try:
+                completed_ids.add(json.loads(line)['id'])
+            except ValueError:
+                break
+            valid_size += len(line)
+
+        jsonl_file.truncate(valid_size)
+
+    return completed_ids
+
+
+class JsonlWriter(): #appends items to <name>.jsonl, each flushed to disk as soon as it is written
+    def __init__(self, name):
+        self.jsonl_file = open(get_jsonl_path(name), 'a')
+
+    def write(self, item):
+        self.jsonl_file.write(json.dumps(item) + "\n")
+        self.jsonl_file.flush()
+
+    def close(self):
+        os.fsync(self.jsonl_file.fileno())
+        self.jsonl_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_jsonl_items(name):
+    with open(get_jsonl_path(name)) as jsonl_file:
+        for line in jsonl_file:
+            yield json.loads(line)
+
+
+def write_json_array(path, values):
+    #json.dump of a list, without holding the list
+    with open(path, 'w') as json_file:
+        json_file.write("[")
+        for index, value in enumerate(values):
+            if index > 0:
+                json_file.write(", ")
+            json.dump(value, json_file)
+        json_file.write("]")
+
+
+def convert_jsonl(name, output_format=OUTPUT_FORMAT):
+    #writes a finished <name>.jsonl in output_format with one item in memory at a time; returns the path(s) written
+    if output_format == "jsonl":
+        return [get_jsonl_path(name)]
+
+    if output_format == "npy" and np is None:
+        print("numpy is not installed, saving embeddings as JSON")
+        output_format = "json"
+
+    if output_format == "json":
+        write_json_array(get_json_path(name), iter_jsonl_items(name))
+        os.remove(get_jsonl_path(name))
+        return [get_json_path(name)]
+
+    #first pass sizes the matrix, the second fills it in place
+    n_items = 0
+    dimension = 0
+    for item in iter_jsonl_items(name):
+        n_items += 1
+        dimension = len(item['embedding'])
+
+    matrix = np.lib.format.open_memmap(get_matrix_path(name), mode='w+', dtype=np.float32, shape=(n_items, dimension))
+
+    def iter_records():
+        for row_index, item in enumerate(iter_jsonl_items(name)):
+            matrix[row_index] = item['embedding']
+            yield {'id': item['id'], 'document': item['document'], 'metadata': item['metadata']}
+
+    write_json_array(get_meta_path(name), iter_records())
+    matrix.flush()
+    del matrix
+
+    os.remove(get_jsonl_path(name))
+    return [get_matrix_path(name), get_meta_path(name)]
+
+
+def iter_json_array(path, read_size=READ_SIZE):
+    #yields the elements of a JSON array file one at a time, reading it in chunks, so memory
+    #holds one element rather than the whole file
+    decoder = json.JSONDecoder()
+
+    with open(path) as json_file:
+        buffer = ""
+        position = 0
+        started = False
+        at_end_of_file = False
+
+        while True:
+            #skip whitespace and the separators between elements
+            while position < len(buffer) and buffer[position] in " \t\r\n" + ("," if started else ""):
+                position += 1
+
+            if position == len(buffer) or not at_end_of_file and len(buffer) - position < read_size:
+                chunk = json_file.read(read_size)
+                buffer = buffer[position:] + chunk
+                position = 0
+                at_end_of_file = not chunk
+
+                if at_end_of_file and not buffer:
+                    raise ValueError(f"{path}: unexpected end of file")
+
+                continue
+
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError(f"{path}: not a JSON array")
+                position += 1
+                started = True
+                continue
+
+            if buffer[position] == "]":
+                return
+
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if at_end_of_file:
+                    raise
+                value, end = None, None
+
+            #an element is complete once the "," or "]" after it is in the buffer (a number
+            #at the end of the buffer could go on in the next chunk)
+            next_position = end if end is not None else len(buffer)
+            while next_position < len(buffer) and buffer[next_position] in " \t\r\n":
+                next_position += 1
+            complete = next_position < len(buffer) and buffer[next_position] in ",]"
+
+            if not complete and at_end_of_file:
+                raise ValueError(f"{path}: expected , or ] after an array element")
+
+            if not complete:
+                #an element longer than the buffer: read on and parse it again
+                chunk = json_file.read(read_size)
+                buffer += chunk
+                at_end_of_file = not chunk
+                continue
+
+            position = end
+            yield value
+
+
+def iter_items(name):
+    #yields the items of <name>.npy + <name>.meta.json, <name>.json or <name>.jsonl one at a time,
+    #each with its 'embedding' as a list of floats
+    if os.path.exists(get_matrix_path(name)) and os.path.exists(get_meta_path(name)):
+        embeddings = np.load(get_matrix_path(name), mmap_mode='r')
+
+        n_records = 0
+        for row_index, record in enumerate(iter_json_array(get_meta_path(name))):
+            n_records += 1
+            if row_index < embeddings.shape[0]:
+                yield dict(record, embedding=embeddings[row_index].tolist())
+
+        if n_records != embeddings.shape[0]:
+            raise ValueError(f"{get_meta_path(name)} has {n_records} items but {get_matrix_path(name)} has {embeddings.shape[0]} rows")
+
+    elif os.path.exists(get_json_path(name)):
+        yield from iter_json_array(get_json_path(name))
+
+    else:
+        yield from iter_jsonl_items(name)
+
+
+def get_item_count(name):
+    #the number of items when it is known without reading the whole file, otherwise None
+    if os.path.exists(get_matrix_path(name)) and os.path.exists(get_meta_path(name)):
+        return np.load(get_matrix_path(name), mmap_mode='r').shape[0]
+
+    return None
+
@@ -0,0 +1,90 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+#concurrent embedding engine: many invoke_model calls in flight, at a bounded request rate
+
+MAX_WORKERS = 16 #concurrent invoke_model calls (the shared client pools 50 connections)
+MAX_REQUESTS_PER_SECOND = 50 #keep under the account's InvokeModel requests-per-minute quota
+MAX_RETRIES = 8
+BASE_BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 20
+PROGRESS_INTERVAL = 100 #print progress every this many items
+PENDING_PER_WORKER = 4 #submitted but not yet consumed items per worker, so memory stays bounded
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException', 'ModelNotReadyException')
+
+
+class RateLimiter(): #spaces requests evenly, shared by all worker threads
+    def __init__(self, max_requests_per_second):
+        self.interval = 1.0 / max_requests_per_second
+        self.next_request_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time)
+            self.next_request_time = request_time + self.interval
+
+        if request_time > now:
+            time.sleep(request_time - now)
+
+
+def call_with_retry(function, argument, rate_limiter):
+    #botocore already retries a few times; under sustained throttling keep backing off
+    #(exponential, with full jitter so the workers do not retry in lockstep)
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.wait()
+        try:
+            return function(argument)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in THROTTLING_ERROR_CODES or attempt == MAX_RETRIES:
+                raise
+            time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt)))
+
+
+def iter_embeddings(inputs, embedding_function, max_workers=MAX_WORKERS, max_requests_per_second=MAX_REQUESTS_PER_SECOND, get_cached=None):
+    #yields embedding_function(input) for every input, in input order, as soon as it is ready;
+    #inputs may be any iterable and only a bounded window of them is in flight at once;
+    #get_cached(input) returns a cached embedding (or None): hits skip the rate limit and retries
+    rate_limiter = RateLimiter(max_requests_per_second)
+    max_pending = max_workers * PENDING_PER_WORKER
+    n_inputs = len(inputs) if hasattr(inputs, '__len__') else None
+    start_time = time.time()
+    n_embedded = 0
+    futures = deque()
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for input in inputs:
+                embedding = get_cached(input) if get_cached is not None else None
+                if embedding is not None:
+                    future = Future()
+                    future.set_result(embedding)
+                else:
+                    future = executor.submit(call_with_retry, embedding_function, input, rate_limiter)
+                futures.append(future)
+                
+                if len(futures) >= max_pending:
+                    yield futures.popleft().result()
+                    n_embedded += 1
+                    print_progress(n_embedded, n_inputs, start_time)
+            
+            while futures:
+                yield futures.popleft().result()
+                n_embedded += 1
+                print_progress(n_embedded, n_inputs, start_time, final=not futures)
+        except BaseException: #including GeneratorExit when the caller stops early
+            executor.shutdown(wait=False, cancel_futures=True) #do not wait for the rest of a failed run
+            raise
+
+
+def print_progress(n_embedded, n_inputs, start_time, final=False):
+    if n_embedded % PROGRESS_INTERVAL == 0 or final:
+        elapsed_time = time.time() - start_time
+        total = f"/{n_inputs}" if n_inputs is not None else ""
+        print(f"Embedded {n_embedded}{total} items ({n_embedded / elapsed_time:.1f} items/s)")
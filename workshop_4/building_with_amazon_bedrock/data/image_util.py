@@ -0,0 +1,59 @@
+import base64
+import hashlib
+import io
+from collections import deque
+
+#image preprocessing for the multimodal embedding pipeline; these functions run in worker
+#processes, so they live here rather than in the prefetch script
+
+#Pillow is in setup/requirements.txt; without it images are sent as they are
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MAX_IMAGE_SIZE = 2048 #Titan Multimodal Embeddings maximum input width/height, in pixels
+JPEG_QUALITY = 90
+PENDING_PER_WORKER = 4 #images preprocessed ahead of the embedding calls, per worker process
+
+
+def get_file_hash(file_path):
+    #identical files get the same hash, whatever their names
+    with open(file_path, "rb") as image_file:
+        return hashlib.sha256(image_file.read()).hexdigest()
+
+
+def get_image_base64(file_path, max_image_size=MAX_IMAGE_SIZE):
+    #base64 of the image, downscaled (keeping the aspect ratio) if it is larger than max_image_size
+    with open(file_path, "rb") as image_file:
+        image_bytes = image_file.read()
+
+    if Image is not None:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if max(image.size) > max_image_size:
+                image_format = image.format if image.format in ('JPEG', 'PNG') else 'PNG'
+
+                image.thumbnail((max_image_size, max_image_size))
+
+                if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+
+                output = io.BytesIO()
+                image.save(output, format=image_format, quality=JPEG_QUALITY)
+                image_bytes = output.getvalue()
+
+    return base64.b64encode(image_bytes).decode('utf8')
+
+
+def iter_images_base64(executor, file_paths, max_pending, max_image_size=MAX_IMAGE_SIZE):
+    #yields get_image_base64 of every file, in order, preprocessing up to max_pending images ahead in the executor
+    futures = deque()
+
+    for file_path in file_paths:
+        futures.append(executor.submit(get_image_base64, file_path, max_image_size))
+
+        if len(futures) >= max_pending:
+            yield futures.popleft().result()
+
+    while futures:
+        yield futures.popleft().result()
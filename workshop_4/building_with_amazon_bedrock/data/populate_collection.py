@@ -1,38 +1,36 @@
-import boto3, json
 import chromadb
+import client_util
+import collection_util
 from chromadb.utils.embedding_functions import AmazonBedrockEmbeddingFunction
 
 #startup script to populate vector db
 
+client = chromadb.PersistentClient() #one client for all collections
+
 def get_text_embeddings_collection(collection_name):
-    session = boto3.Session()
-    embedding_function = AmazonBedrockEmbeddingFunction(session=session, model_name="amazon.titan-embed-text-v2:0")
+    #the embedding function creates its Bedrock client from the shared session, under the client lock
+    embedding_function = client_util.call_with_session(
+        lambda session: AmazonBedrockEmbeddingFunction(session=session, model_name="amazon.titan-embed-text-v2:0"))
     
-    client = chromadb.PersistentClient()
     index = client.get_or_create_collection(collection_name, embedding_function=embedding_function)
     
     return index
 
 
-def initialize_collection(collection_name, source_json_file):
+def initialize_collection(collection_name, source_name):
     
     collection = get_text_embeddings_collection(collection_name)
     
     if collection.count() == 0:
         
-        row_count = 0
+        #batched collection.add calls, each within the client's maximum batch size
+        collection_util.load_collection(collection, source_name,
+            max_batch_size=collection_util.get_max_batch_size(client))
+    else:
         
-        with open(source_json_file) as json_file:
-            source_json = json.load(json_file)
-            
-            for item in source_json:
-                row_count = row_count + 1
-                collection.add(
-                    ids=[str(item['id'])],
-                    documents=[item['document']],
-                    metadatas=[item['metadata']],
-                    embeddings=[item['embedding']]
-                )
+        #only the items that changed since the last load are written, removed ones deleted
+        collection_util.sync_collection(collection, source_name,
+            max_batch_size=collection_util.get_max_batch_size(client))
     
     print(f"Initialized collection {collection_name}")
     
@@ -40,7 +38,7 @@ def initialize_collection(collection_name, source_json_file):
 
 
 
-initialize_collection('services_collection', 'services_with_embeddings.json')
+initialize_collection('services_collection', 'services_with_embeddings')
 
-initialize_collection('bedrock_faqs_collection', 'bedrock_faqs_with_embeddings.json')
+initialize_collection('bedrock_faqs_collection', 'bedrock_faqs_with_embeddings')
 
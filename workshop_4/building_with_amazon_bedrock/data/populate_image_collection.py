@@ -1,34 +1,30 @@
-import boto3, json
 import chromadb
+import collection_util
 
 #startup script to populate vector db
 
+client = chromadb.PersistentClient() #one client for all collections
+
 def get_multimodal_embeddings_collection(collection_name):
-    client = chromadb.PersistentClient()
     index = client.get_or_create_collection(collection_name)
     
     return index
 
 
-def initialize_collection(collection_name, source_json_file):
+def initialize_collection(collection_name, source_name):
     
     collection = get_multimodal_embeddings_collection(collection_name)
     
     if collection.count() == 0:
         
-        row_count = 0
+        #batched collection.add calls, each within the client's maximum batch size
+        collection_util.load_collection(collection, source_name,
+            max_batch_size=collection_util.get_max_batch_size(client))
+    else:
         
-        with open(source_json_file) as json_file:
-            source_json = json.load(json_file)
-            
-            for item in source_json:
-                row_count = row_count + 1
-                collection.add(
-                    ids=[str(item['id'])],
-                    documents=[item['document']],
-                    metadatas=[item['metadata']],
-                    embeddings=[item['embedding']]
-                )
+        #only the items that changed since the last load are written, removed ones deleted
+        collection_util.sync_collection(collection, source_name,
+            max_batch_size=collection_util.get_max_batch_size(client))
     
     print(f"Initialized collection {collection_name}")
     
@@ -36,6 +32,6 @@ def initialize_collection(collection_name, source_json_file):
 
 
 
-initialize_collection('images_collection', 'images_with_embeddings.json')
+initialize_collection('images_collection', 'images_with_embeddings')
 
 
@@ -1,15 +1,40 @@
-import boto3, json
+import json
+import client_util
+import embedding_cache_util
+import embedding_store_util
+import embedding_util
 
 #Load directory/csv/json-process and store metadata, docs, ids, and embeddings
 
 
+TEXT_EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"
+TEXT_EMBEDDING_DIMENSION = 1024 #Titan Text Embeddings v2 default
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite" #shared with rag_chatbot_lib
+
+
+def get_cached_text_embedding(text):
+    #unchanged documents are served from the embedding cache (None on a miss), without a Bedrock call
+    embedding_cache = embedding_cache_util.get_embedding_cache(EMBEDDING_CACHE_PATH)
+    
+    return embedding_cache.get(TEXT_EMBEDDING_MODEL_ID, TEXT_EMBEDDING_DIMENSION, text=text)
+
+
 def get_text_embedding(text):
-    session = boto3.Session()
-    bedrock = session.client(service_name='bedrock-runtime') #creates a Bedrock client
+    #called for cache misses only: embeds the text with Bedrock and caches the embedding
+    embedding = invoke_text_embedding_model(text)
+    
+    embedding_cache = embedding_cache_util.get_embedding_cache(EMBEDDING_CACHE_PATH)
+    embedding_cache.put(TEXT_EMBEDDING_MODEL_ID, TEXT_EMBEDDING_DIMENSION, embedding, text=text)
+    
+    return embedding
+
+
+def invoke_text_embedding_model(text):
+    bedrock = client_util.get_client('bedrock-runtime') #reuses a shared Bedrock client
     
     response = bedrock.invoke_model(
         body=json.dumps({ "inputText": text }), 
-        modelId="amazon.titan-embed-text-v2:0", 
+        modelId=TEXT_EMBEDDING_MODEL_ID, 
         accept="application/json",
         contentType="application/json"
     )
@@ -18,6 +43,31 @@ def get_text_embedding(text):
     return response_body['embedding']
     
 
+def serialize_embeddings(name, processed_items):
+    #embeds the documents concurrently and appends each finished item to <name>.jsonl, so only
+    #the documents stay in memory and a rerun after a crash resumes where the last one stopped
+    completed_ids = embedding_store_util.load_completed_ids(name)
+    pending_items = [item for item in processed_items if item['id'] not in completed_ids]
+    
+    if completed_ids:
+        print(f"Resuming {name}: {len(completed_ids)} items already embedded, {len(pending_items)} to go")
+    
+    #cache hits are resolved up front; only Bedrock calls are rate-limited
+    embeddings = embedding_util.iter_embeddings([item['document'] for item in pending_items], get_text_embedding,
+        get_cached=get_cached_text_embedding)
+    
+    with embedding_store_util.JsonlWriter(name) as writer:
+        for item_dict, embedding in zip(pending_items, embeddings):
+            writer.write(dict(item_dict, embedding=embedding))
+    
+    #float32 matrix + metadata file (embedding_store_util.OUTPUT_FORMAT), read by populate_collection
+    saved_paths = embedding_store_util.convert_jsonl(name)
+    
+    print(f"Saved {', '.join(saved_paths)} to disk!")
+    
+    embedding_cache_util.get_embedding_cache(EMBEDDING_CACHE_PATH).print_stats()
+
+
 def serialize_services_embeddings():
     
     processed_items = []
@@ -28,12 +78,10 @@ def serialize_services_embeddings():
         
         for item in services_json:
             row_count = row_count + 1
-            print(f"Processing item: {row_count}")
             item_dict = {
                 'id': str(row_count),
                 'document': item['description'],
-                'metadata': {'name': item['name'], 'url': item['url'] },
-                'embedding': get_text_embedding(item['description'])
+                'metadata': {'name': item['name'], 'url': item['url'] }
             }
             
             processed_items.append(item_dict)
@@ -43,11 +91,7 @@ def serialize_services_embeddings():
             #    documents=[item['description']],
             #    metadatas=[{'name': item['name'], 'url': item['url'] }])
     
-    with open('services_with_embeddings.json', 'w') as json_file:
-        json.dump(processed_items, json_file)
-
-
-    print("Saved services_with_embeddings.json to disk!")
+    serialize_embeddings('services_with_embeddings', processed_items)
 
 
 def serialize_faqs_embeddings():
@@ -61,12 +105,10 @@ def serialize_faqs_embeddings():
         
         for item in services_json:
             row_count = row_count + 1
-            print(f"Processing item: {row_count}")
             item_dict = {
                 'id': str(row_count),
                 'document': item['question'] + "\n" + item['answer'],
-                'metadata': {'topic': 'bedrock' },
-                'embedding': get_text_embedding(item['question'] + "\n" + item['answer'])
+                'metadata': {'topic': 'bedrock' }
             }
             
             processed_items.append(item_dict)
@@ -76,11 +118,7 @@ def serialize_faqs_embeddings():
             #    documents=[item['description']],
             #    metadatas=[{'name': item['name'], 'url': item['url'] }])
     
-    with open('bedrock_faqs_with_embeddings.json', 'w') as json_file:
-        json.dump(processed_items, json_file)
-    
-    
-    print("Saved bedrock_faqs_with_embeddings.json to disk!")
+    serialize_embeddings('bedrock_faqs_with_embeddings', processed_items)
 
 
 serialize_faqs_embeddings()
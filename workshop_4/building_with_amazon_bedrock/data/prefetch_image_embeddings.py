@@ -1,12 +1,42 @@
-import boto3, json, base64, os
+import json, os
+from concurrent.futures import ProcessPoolExecutor
+import client_util
+import embedding_cache_util
+import embedding_store_util
+import embedding_util
+import image_util
 
 
-#calls Amazon Bedrock to get a vector from either an image, text, or both
-def get_multimodal_vector(input_image_base64=None, input_text=None):
+IMAGE_EMBEDDING_MODEL_ID = "amazon.titan-embed-image-v1"
+IMAGE_EMBEDDING_DIMENSION = 1024 #Titan Multimodal Embeddings default
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite" #shared with prefetch_embeddings and rag_chatbot_lib
+IMAGE_PATH = "../labs/image_search/images"
+MAX_PREPROCESS_WORKERS = os.cpu_count() #processes decoding and downscaling images
+
+
+#gets the cached vector of an image (None on a miss), without a Bedrock call
+def get_cached_image_vector(input_image_base64):
     
-    session = boto3.Session()
+    embedding_cache = embedding_cache_util.get_embedding_cache(EMBEDDING_CACHE_PATH)
+    
+    return embedding_cache.get(IMAGE_EMBEDDING_MODEL_ID, IMAGE_EMBEDDING_DIMENSION, image=input_image_base64)
+
 
-    bedrock = session.client(service_name='bedrock-runtime') #creates a Bedrock client
+#gets the vector of an image missing from the cache from Amazon Bedrock, and caches it
+def get_image_vector(input_image_base64):
+    
+    embedding = invoke_multimodal_embedding_model(input_image_base64=input_image_base64)
+    
+    embedding_cache = embedding_cache_util.get_embedding_cache(EMBEDDING_CACHE_PATH)
+    embedding_cache.put(IMAGE_EMBEDDING_MODEL_ID, IMAGE_EMBEDDING_DIMENSION, embedding, image=input_image_base64)
+    
+    return embedding
+
+
+#calls Amazon Bedrock to get a vector from either an image, text, or both
+def invoke_multimodal_embedding_model(input_image_base64=None, input_text=None):
+    
+    bedrock = client_util.get_client('bedrock-runtime') #reuses a shared Bedrock client
     
     request_body = {}
     
@@ -20,7 +50,7 @@ def get_multimodal_vector(input_image_base64=None, input_text=None):
     
     response = bedrock.invoke_model(
     	body=body, 
-    	modelId="amazon.titan-embed-image-v1", 
+    	modelId=IMAGE_EMBEDDING_MODEL_ID, 
     	accept="application/json", 
     	contentType="application/json"
     )
@@ -32,46 +62,57 @@ def get_multimodal_vector(input_image_base64=None, input_text=None):
     return embedding
 
 
-#creates a vector from a file
-def get_vector_from_file(file_path):
-    with open(file_path, "rb") as image_file:
-        input_image_base64 = base64.b64encode(image_file.read()).decode('utf8')
-    
-    vector = get_multimodal_vector(input_image_base64 = input_image_base64)
-    
-    return vector
-
-
 def serialize_image_embeddings():
     
-    processed_items = []
-    row_count = 0
+    name = 'images_with_embeddings'
     
-    path = "../labs/image_search/images"
+    files = sorted(os.listdir(IMAGE_PATH)) #sorted, so the ids stay the same when a run is resumed
+    ids = dict((file, str(row_count)) for row_count, file in enumerate(files, start=1))
+    completed_ids = embedding_store_util.load_completed_ids(name)
     
-    for file in os.listdir(path):
-        file_path = os.path.join(path, file)
+    with ProcessPoolExecutor(max_workers=MAX_PREPROCESS_WORKERS) as executor:
+        
+        #group identical files by content hash, so each distinct image is embedded once
+        files_by_hash = {}
+        file_hashes = executor.map(image_util.get_file_hash, [os.path.join(IMAGE_PATH, file) for file in files], chunksize=16)
+        for file, file_hash in zip(files, file_hashes):
+            files_by_hash.setdefault(file_hash, []).append(file)
+        
+        pending_groups = [group_files for group_files in files_by_hash.values()
+            if any(ids[file] not in completed_ids for file in group_files)]
         
-        embedding = get_vector_from_file(file_path)
+        print(f"{len(files)} images, {len(files_by_hash)} distinct, {len(pending_groups)} to embed")
         
-        row_count = row_count + 1
-        print(f"Processing item: {row_count}")
-        item_dict = {
-            'id': str(row_count),
-            'document': f"images/{file}",
-            'metadata': {'file_path': f"images/{file}" },
-            'embedding': embedding
-        }
+        #the worker processes decode and downscale images while the embedding threads call Bedrock
+        images_base64 = image_util.iter_images_base64(executor,
+            [os.path.join(IMAGE_PATH, group_files[0]) for group_files in pending_groups],
+            max_pending=MAX_PREPROCESS_WORKERS * image_util.PENDING_PER_WORKER)
         
-        processed_items.append(item_dict)
+        #cache hits are resolved up front; only Bedrock calls are rate-limited
+        embeddings = embedding_util.iter_embeddings(images_base64, get_image_vector,
+            get_cached=get_cached_image_vector)
+        
+        with embedding_store_util.JsonlWriter(name) as writer:
+            for group_files, embedding in zip(pending_groups, embeddings):
+                for file in group_files:
+                    if ids[file] not in completed_ids:
+                        writer.write({
+                            'id': ids[file],
+                            'document': f"images/{file}",
+                            'metadata': {'file_path': f"images/{file}" },
+                            'embedding': embedding
+                        })
+    
     
+    #float32 matrix + metadata file (embedding_store_util.OUTPUT_FORMAT), read by populate_image_collection
+    saved_paths = embedding_store_util.convert_jsonl(name)
     
-    with open('images_with_embeddings.json', 'w') as json_file:
-        json.dump(processed_items, json_file)
     
+    print(f"Saved {', '.join(saved_paths)} to disk!")
     
-    print("Saved images_with_embeddings.json to disk!")
+    embedding_cache_util.get_embedding_cache(EMBEDDING_CACHE_PATH).print_stats()
 
 
 
-serialize_image_embeddings()
+if __name__ == "__main__": #with the spawn start method (macOS, Windows) the worker processes import this script too
+    serialize_image_embeddings()
@@ -1,11 +1,12 @@
-import boto3
 import itertools
 import chromadb
+import client_util
 from chromadb.utils.embedding_functions import AmazonBedrockEmbeddingFunction
 
 def get_text_embeddings_collection(collection_name):
-    session = boto3.Session()
-    embedding_function = AmazonBedrockEmbeddingFunction(session=session, model_name="amazon.titan-embed-text-v2:0")
+    #the embedding function creates its Bedrock client from the shared session, under the client lock
+    embedding_function = client_util.call_with_session(
+        lambda session: AmazonBedrockEmbeddingFunction(session=session, model_name="amazon.titan-embed-text-v2:0"))
     
     client = chromadb.PersistentClient()
     index = client.get_or_create_collection(collection_name, embedding_function=embedding_function)
@@ -23,9 +24,6 @@ def get_vector_search_results(collection, question):
     
 def get_similarity_search_results(collection_name, question):
 
-    session = boto3.Session()
-    bedrock = session.client(service_name='bedrock-runtime')
-    
     collection = get_text_embeddings_collection(collection_name)
     
     search_results = get_vector_search_results(collection, question)